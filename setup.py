@@ -20,7 +20,6 @@ setuptools.setup(
     ],
     install_requires=[
         "aiohttp>=3.7.4,<4",
-        "inflection~=0.5",
         "pyjwt~=2.4",
         "python-dateutil~=2.8",
     ],
@@ -5,9 +5,7 @@ import logging
 from pprint import pprint
 import sys
 
-import aiohttp
-
-from . import SmartTub, SpaLight
+from . import DesiredState, FileTokenStore, SmartTub, SpaLight, SpaPump
 
 # Temperature conversion helpers
 def fahrenheit(c):
@@ -211,55 +209,48 @@ async def info_command(spas, args):
 
 async def set_command(spas, args):
     for spa in spas:
-        if args.temperature:
-            await spa.set_temperature(args.temperature)
-
-        # Handle pump on/off operations
-        if args.turnon or args.turnoff:
-            turnon = pumplist(args.turnon) if args.turnon else []
-            turnoff = pumplist(args.turnoff) if args.turnoff else []
-
-            pumps = await spa.get_pumps()
-            for pump in pumps:
-                pump_state = pump.state
-                if pump.id in turnon and pump_state == pump.PumpState.OFF:
-                    if pump.id != 'CP':
-                        await pump.toggle()
-                        if args.verbosity > 0:
-                            print(f"Turned on {pumpalias(pump.id)}")
-                elif pump.id in turnoff and pump_state != pump.PumpState.OFF:
-                    if pump.id != 'CP':
-                        await pump.toggle()
-                        if args.verbosity > 0:
-                            print(f"Turned off {pumpalias(pump.id)}")
-
-        # Handle light mode (original upstream syntax)
+        # Temperature, pumps and lights are applied together, see Spa.apply
+        pumps = {}
+        if args.turnoff:
+            pumps.update((pump_id, False) for pump_id in pumplist(args.turnoff))
+        if args.turnon:
+            pumps.update((pump_id, True) for pump_id in pumplist(args.turnon))
+        # the circulation pump isn't switched from here
+        pumps.pop('CP', None)
+
+        # Handle light mode (original upstream syntax): every light the spa has
+        all_lights_mode = None
         if args.light_mode:
-            for light in await spa.get_lights():
-                if args.verbosity > 0:
-                    print(light)
-                mode = light.LightMode[args.light_mode]
-                if mode == light.LightMode.OFF:
-                    await light.set_mode(mode, 0)
-                else:
-                    await light.set_mode(mode, 50)
-
+            mode = SpaLight.LightMode[args.light_mode]
+            intensity = 0 if mode == SpaLight.LightMode.OFF else 50
+            all_lights_mode = (mode, intensity)
+        lights = {}
         # Handle lights with custom syntax (e.g., "ALL:RED", "SEATS:BLUE")
         if args.lights:
-            lights = await spa.get_lights()
-            lightops = lightoperations(args.lights)
-            for light in lights:
-                try:
-                    modename = lightops[light.zone]
-                    if modename == 'OFF':
-                        await light.set_mode(light.LightMode.OFF, 0)
-                    else:
-                        await light.set_mode(lightmode(modename), 100)
-                    if args.verbosity > 0:
-                        print(f"Set {lightname(light.zone)} to {modename}")
-                except KeyError:
-                    # This light zone not specified in the operations
-                    pass
+            for zone, modename in lightoperations(args.lights).items():
+                if modename == 'OFF':
+                    lights[zone] = (SpaLight.LightMode.OFF, 0)
+                else:
+                    lights[zone] = (lightmode(modename), 100)
+
+        desired = DesiredState(
+            set_temperature=args.temperature,
+            pumps=pumps or None,
+            lights=lights or None,
+            all_lights=all_lights_mode,
+        )
+        if desired != DesiredState():
+            changes = await spa.apply(desired, ignore_missing=True)
+            if args.verbosity > 0:
+                for target in changes:
+                    if isinstance(target, SpaPump):
+                        state = 'on' if pumps[target.id] else 'off'
+                        print(f"Turned {state} {pumpalias(target.id)}")
+                    elif isinstance(target, SpaLight):
+                        mode, _ = lights.get(target.zone, all_lights_mode)
+                        print(f"Set {lightname(target.zone)} to {mode.name}")
+                    elif target == 'set_temperature':
+                        print(f"Set temperature to {args.temperature}")
 
         if args.snooze_reminder:
             reminder_id, days = args.snooze_reminder
@@ -303,6 +294,12 @@ async def main(argv):
         "-p", "--password", required=True, help="SmartTub account password"
     )
     parser.add_argument("-v", "--verbosity", action="count", default=0)
+    parser.add_argument(
+        "--token-cache",
+        metavar="FILE",
+        help="Save login tokens to FILE and reuse them on later runs "
+        f"(e.g. {FileTokenStore.DEFAULT_PATH})",
+    )
     subparsers = parser.add_subparsers()
 
     info_parser = subparsers.add_parser("info", help="Show information about the spa")
@@ -370,8 +367,8 @@ async def main(argv):
 
     logging.basicConfig(level=log_level)
 
-    async with aiohttp.ClientSession() as session:
-        st = SmartTub(session)
+    token_store = FileTokenStore(args.token_cache) if args.token_cache else None
+    async with SmartTub(token_store=token_store) as st:
         await st.login(args.username, args.password)
 
         account = await st.get_account()
@@ -1,20 +1,49 @@
+import abc
 import asyncio
+import collections
+import contextlib
 import datetime
+import email.utils
 from enum import Enum
+import functools
+import json
 import logging
+import os
+import random
+import tempfile
 import time
-from typing import List
+from types import MappingProxyType
+from typing import Any, Callable, List, Mapping, NamedTuple, Optional
+from urllib.parse import urlsplit
 
 import aiohttp
 import dateutil.parser
-from inflection import underscore
 import jwt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on Windows; FileTokenStore falls back to no locking
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
 
 class SmartTub:
-    """Interface to the SmartTub API"""
+    """Interface to the SmartTub API
+
+    If no session is given, SmartTub creates (and owns) one with a connection
+    pool tuned for the API. Use it as an async context manager, or call
+    close(), to release the connections:
+
+        async with SmartTub() as st:
+            await st.login(username, password)
+    """
 
     AUTH_AUDIENCE = "https://api.operation-link.com/"
     AUTH_URL = "https://smarttub.auth0.com/oauth/token"
@@ -26,9 +55,137 @@ class SmartTub:
 
     API_BASE = "https://api.smarttub.io"
 
-    def __init__(self, session: aiohttp.ClientSession = None):
+    # refresh the access token this many seconds before it actually expires
+    TOKEN_REFRESH_SKEW = 60
+    # whether pumps, lights etc. keep a reference to their raw JSON in .properties
+    keep_raw_properties = True
+    # default limit on simultaneous requests to the API
+    MAX_CONCURRENT_REQUESTS = 10
+    # default time allowed for each request attempt, in seconds
+    REQUEST_TIMEOUT = 30
+    # connection pool settings, used when SmartTub creates its own session
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+    # number of distinct timestamp strings to remember parsed values for
+    TIMESTAMP_CACHE_SIZE = 4096
+    # number of GET responses to remember for conditional requests
+    RESPONSE_CACHE_SIZE = 256
+    # seconds to reuse slow-changing resources for, without asking the API;
+    # pumps, lights and reminders carry live state, so are only cached on request
+    RESOURCE_CACHE_TTL = MappingProxyType(
+        {
+            "account": 3600,
+            "spas": 3600,
+            "spa": 3600,
+            "pumps": 0,
+            "lights": 0,
+            "reminders": 0,
+        }
+    )
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession = None,
+        *,
+        token_refresh_skew: float = TOKEN_REFRESH_SKEW,
+        token_store: "TokenStore" = None,
+        max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS,
+        rate_limit: float = None,
+        rate_limit_burst: int = None,
+        retry_policy: "RetryPolicy" = None,
+        timeout: float = REQUEST_TIMEOUT,
+        connection_limit: int = None,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+        dns_cache_ttl: int = DNS_CACHE_TTL,
+        connector: aiohttp.BaseConnector = None,
+        json_codec: "JSONCodec" = None,
+        keep_raw_properties: bool = True,
+        timestamp_cache_size: int = TIMESTAMP_CACHE_SIZE,
+        response_cache_size: int = RESPONSE_CACHE_SIZE,
+        resource_cache_ttl: Mapping[str, float] = None,
+        coalesce_requests: bool = True,
+    ):
+        """
+        session -- an aiohttp session to use instead of creating one
+        connection_limit -- size of the connection pool (default: max_concurrent_requests)
+        keepalive_timeout -- seconds to keep idle connections open for reuse
+        dns_cache_ttl -- seconds to cache DNS lookups
+        connector -- a custom connector (transport) for the session SmartTub creates
+        json_codec -- encodes request bodies and decodes responses (default: orjson if installed)
+        keep_raw_properties -- set to False to save memory when holding many pumps and lights
+        timestamp_cache_size -- how many parsed timestamps to share between spa states
+        response_cache_size -- how many GET responses to cache (0 to disable), see ResponseCache
+        resource_cache_ttl -- overrides for RESOURCE_CACHE_TTL, e.g. {"pumps": 0} to always fetch pumps
+        coalesce_requests -- let concurrent identical GETs share one HTTP request
+        """
+
         self.logged_in = False
-        self._session = session or aiohttp.ClientSession()
+        self._session = session
+        self._owns_session = session is None
+        self._connector = connector
+        self.connection_limit = (
+            connection_limit
+            if connection_limit is not None
+            else max_concurrent_requests or 0
+        )
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.token_refresh_skew = token_refresh_skew
+        self.token_store = token_store
+        self.username = None
+        self.access_token = None
+        self.access_token_data = None
+        self._refresh_task = None
+        self._refresher_task = None
+        self.stats = RequestStats()
+        self.scheduler = RequestScheduler(
+            max_concurrent_requests, rate_limit, rate_limit_burst, self.stats
+        )
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.retry_budget = self.retry_policy.budget
+        self.timeout = timeout
+        self.json_codec = json_codec or default_json_codec()
+        self.keep_raw_properties = keep_raw_properties
+        self.response_cache = (
+            ResponseCache(response_cache_size) if response_cache_size else None
+        )
+        self.resource_cache_ttl = {
+            **self.RESOURCE_CACHE_TTL,
+            **(resource_cache_ttl or {}),
+        }
+        self._cache = TTLCache(self.resource_cache_ttl, ("account",))
+        self.coalesce_requests = coalesce_requests
+        # path -> _InflightRequest for GETs in progress, shared by concurrent
+        # callers
+        self._inflight = {}
+        self._timestamp_cache = functools.lru_cache(maxsize=timestamp_cache_size)(
+            _parse_timestamp
+        )
+
+    async def __aenter__(self):
+        self._get_session()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Stop background tasks, and close the session if SmartTub created it"""
+
+        await self.stop_token_refresher()
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            connector = self._connector or aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
 
     async def login(self, username: str, password: str):
         """Authenticate to SmartTub
@@ -37,10 +194,17 @@ class SmartTub:
 
         username -- the email address for the SmartTub account
         password -- the password for the SmartTub account
+
+        If a token_store was provided, tokens saved by a previous session for
+        the same username are reused instead of logging in again.
         """
 
+        self.invalidate_cache()
+        if self.token_store is not None and await self.resume(username):
+            return
+
         # https://auth0.com/docs/api-auth/tutorials/password-grant
-        r = await self._session.post(
+        r = await self._get_session().post(
             self.AUTH_URL,
             json={
                 "audience": self.AUTH_AUDIENCE,
@@ -63,32 +227,128 @@ class SmartTub:
         assert j["token_type"] == "Bearer"
 
         self.account_id = self.access_token_data[self.AUTH_ACCOUNT_ID_KEY]
+        self.username = username
         self.logged_in = True
+        await self._save_tokens()
 
         logger.debug(f"login successful, username={username}")
 
+    async def resume(self, username: str = None) -> bool:
+        """Authenticate using tokens saved in the token store
+
+        The access token is refreshed if it has expired. Returns False if there
+        are no usable saved tokens, in which case login() is required.
+
+        username -- if specified, only resume a session for this account
+        """
+
+        if self.token_store is None:
+            raise RuntimeError("no token store configured")
+        loop = asyncio.get_running_loop()
+        try:
+            tokens = await loop.run_in_executor(None, self.token_store.load)
+        except Exception as e:
+            # the store is only a cache: log in as if it were empty
+            logger.warning(f"could not load saved tokens: {e!r}")
+            return False
+        if not tokens:
+            return False
+        if username is not None and tokens.get("username") != username:
+            return False
+
+        try:
+            self._set_access_token(tokens["access_token"])
+            self.refresh_token = tokens["refresh_token"]
+            self.account_id = tokens["account_id"]
+        except (KeyError, jwt.InvalidTokenError) as e:
+            logger.warning(f"ignoring invalid saved tokens: {e!r}")
+            return False
+        self.username = tokens.get("username")
+        self.logged_in = True
+
+        try:
+            await self._require_login()
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            KeyError,
+            jwt.InvalidTokenError,
+        ) as e:
+            # e.g. the refresh token was revoked, or the response was malformed
+            logger.warning(f"could not refresh saved token: {e!r}")
+            self.logged_in = False
+            return False
+
+        logger.debug(f"resumed session, username={self.username}")
+        return True
+
+    async def _save_tokens(self):
+        if self.token_store is None:
+            return
+        tokens = {
+            "username": self.username,
+            "account_id": self.account_id,
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+        }
+        # saving locks and syncs the file, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.token_store.save, tokens)
+        except Exception as e:
+            # we are logged in regardless; the next session will log in again
+            logger.warning(f"could not save tokens: {e!r}")
+
     @property
     def _headers(self):
-        return {"Authorization": f"Bearer {self.access_token}"}
+        return self._auth_headers
 
     async def _require_login(self):
         if not self.logged_in:
             raise RuntimeError("not logged in")
-        if self.token_expires_at <= time.time():
-            await self._refresh_token()
+        if self.token_expires_at - self.token_refresh_skew <= time.time():
+            await self._refresh_token_shared()
 
     def _set_access_token(self, token):
-        self.access_token = token
-        self.access_token_data = jwt.decode(
-            self.access_token,
-            algorithms=["HS256"],
-            options={"verify_signature": False, "verify": False},
+        if token == self.access_token:
+            return
+        # decode once per token; the claims and headers are reused by every request
+        self.access_token_data = MappingProxyType(
+            jwt.decode(
+                token,
+                algorithms=["HS256"],
+                options={"verify_signature": False, "verify": False},
+            )
         )
+        self.access_token = token
         self.token_expires_at = self.access_token_data["exp"]
+        self._auth_headers = MappingProxyType({"Authorization": f"Bearer {token}"})
+        self._auth_json_headers = MappingProxyType(
+            {**self._auth_headers, "Content-Type": "application/json"}
+        )
+
+    async def _refresh_token_shared(self):
+        """Refresh the access token, sharing one in-flight refresh among all callers
+
+        Concurrent requests which all notice that the token is about to expire
+        await the same refresh instead of each issuing their own.
+        """
+
+        task = self._refresh_task
+        if task is None:
+            task = asyncio.ensure_future(self._refresh_token())
+            task.add_done_callback(self._refresh_done)
+            self._refresh_task = task
+        # shield so that a cancelled waiter doesn't cancel the refresh for the others
+        await asyncio.shield(task)
+
+    def _refresh_done(self, task):
+        if self._refresh_task is task:
+            self._refresh_task = None
 
     async def _refresh_token(self):
         # https://auth0.com/docs/tokens/guides/use-refresh-tokens
-        r = await self._session.post(
+        r = await self._get_session().post(
             self.AUTH_URL,
             json={
                 "grant_type": "refresh_token",
@@ -99,43 +359,314 @@ class SmartTub:
         r.raise_for_status()
         j = await r.json()
         self._set_access_token(j["access_token"])
+        # Auth0 may rotate the refresh token
+        self.refresh_token = j.get("refresh_token", self.refresh_token)
+        await self._save_tokens()
         logger.debug("token refresh successful")
 
-    async def request(self, method, path, body=None):
-        """Generic method for making an authenticated request to the API
-
-        This is used by resource objects associated with this API object
+    def start_token_refresher(
+        self,
+        lead_time: float = None,
+        jitter: float = 30,
+        min_backoff: float = 1,
+        max_backoff: float = 300,
+        on_refresh: Callable[[float, Optional[Exception]], None] = None,
+        min_interval: float = 30,
+    ) -> asyncio.Task:
+        """Keep the access token fresh from a background task
+
+        The token is refreshed somewhere between lead_time and lead_time + jitter
+        seconds before it expires, so that requests never have to wait for a
+        refresh themselves. Failed refreshes are retried with exponential backoff.
+        Use stop_token_refresher() (or cancel the returned task) to stop it.
+
+        lead_time -- seconds before expiry to refresh (default: token_refresh_skew)
+        jitter -- random extra lead time, to spread out refreshes of many sessions
+        min_backoff -- delay before retrying after the first failed refresh
+        max_backoff -- upper bound on the delay between retries
+        on_refresh -- called after each attempt with (elapsed seconds, exception or None)
+        min_interval -- least time between successful refreshes, in case tokens
+            are issued with a lifetime shorter than lead_time
         """
 
-        await self._require_login()
-
-        r = await self._session.request(
-            method, f"{self.API_BASE}/{path}", headers=self._headers, json=body
+        if not self.logged_in:
+            raise RuntimeError("not logged in")
+        if self._refresher_task is not None and not self._refresher_task.done():
+            raise RuntimeError("token refresher already running")
+        if lead_time is None:
+            lead_time = self.token_refresh_skew
+
+        self._refresher_task = asyncio.ensure_future(
+            self._run_token_refresher(
+                lead_time, jitter, min_backoff, max_backoff, on_refresh, min_interval
+            )
         )
+        return self._refresher_task
 
+    async def stop_token_refresher(self):
+        """Stop the background task started by start_token_refresher()"""
+
+        task, self._refresher_task = self._refresher_task, None
+        if task is None:
+            return
+        task.cancel()
         try:
-            r.raise_for_status()
-        except aiohttp.ClientResponseError as e:
-            raise APIError(e)
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def _token_refresh_delay(self, lead_time, jitter) -> float:
+        # refresh between lead_time and lead_time + jitter seconds before expiry
+        return (
+            self.token_expires_at - lead_time - random.uniform(0, jitter) - time.time()
+        )
 
-        if int(r.headers["content-length"]) == 0:
-            ret = None
-        else:
-            ret = await r.json()
+    async def _run_token_refresher(
+        self, lead_time, jitter, min_backoff, max_backoff, on_refresh, min_interval
+    ):
+        failures = 0
+        refreshed = False
+        while True:
+            if failures:
+                backoff = min(max_backoff, min_backoff * 2 ** (failures - 1))
+                delay = random.uniform(backoff / 2, backoff)
+            else:
+                delay = self._token_refresh_delay(lead_time, jitter)
+                if refreshed:
+                    # don't refresh back to back if tokens are short-lived
+                    delay = max(delay, min_interval)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            start = time.monotonic()
+            error = None
+            try:
+                await self._refresh_token_shared()
+            except Exception as e:
+                failures += 1
+                error = e
+                logger.warning(f"background token refresh failed: {e!r}")
+            else:
+                failures = 0
+                refreshed = True
+            elapsed = time.monotonic() - start
+
+            if on_refresh is not None:
+                try:
+                    on_refresh(elapsed, error)
+                except Exception:
+                    logger.exception("token refresh hook failed")
+
+    async def request(
+        self, method, path, body=None, *, timeout: float = None, deadline: float = None
+    ):
+        """Generic method for making an authenticated request to the API
+
+        This is used by resource objects associated with this API object.
+        Transient failures are retried according to self.retry_policy.
+
+        timeout -- seconds allowed for each attempt (default: self.timeout)
+        deadline -- a time.monotonic() value by which the request, including
+            any retries, must complete
+
+        Raises asyncio.TimeoutError if the timeout or deadline is exceeded.
+
+        A GET issued while an identical one is in progress waits for that
+        request's result instead of making another, unless
+        coalesce_requests is False. It only does so if the request in
+        progress has a timeout and deadline at least as generous as its own,
+        and makes its own request if that one times out before its deadline.
+        """
+
+        if not (self.coalesce_requests and method == "GET" and body is None):
+            return await self._request(method, path, body, timeout, deadline)
+
+        if timeout is None:
+            timeout = self.timeout
+        inflight = self._inflight.get(path)
+        if inflight is not None and inflight.covers(timeout, deadline):
+            self.stats.coalesced += 1
+            logger.debug(f"{method} {path} joined a request in progress")
+            try:
+                if deadline is None:
+                    value = await asyncio.shield(inflight.task)
+                else:
+                    # our own deadline still applies while waiting
+                    value = await asyncio.wait_for(
+                        asyncio.shield(inflight.task), deadline - time.monotonic()
+                    )
+                # a copy, so that callers can't change each other's responses
+                return _copy_json(value)
+            except asyncio.TimeoutError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                logger.debug(f"{method} {path} timed out for others, retrying")
+
+        task = asyncio.ensure_future(
+            self._request(method, path, body, timeout, deadline)
+        )
+        self._inflight[path] = _InflightRequest(task, timeout, deadline)
+        task.add_done_callback(functools.partial(self._request_done, path))
+        # cancelling one caller mustn't cancel the request for the others
+        return await asyncio.shield(task)
+
+    def _request_done(self, path, task):
+        inflight = self._inflight.get(path)
+        if inflight is not None and inflight.task is task:
+            del self._inflight[path]
+        if not task.cancelled():
+            # retrieve the exception, in case every caller has gone away
+            task.exception()
+
+    async def _request(self, method, path, body, timeout, deadline):
+        url = f"{self.API_BASE}/{path}"
+        if timeout is None:
+            timeout = self.timeout
+        attempt = 1
+        while True:
+            await self._require_login()
+            try:
+                ret = await self._send_before(method, url, body, timeout, deadline)
+                break
+            except (APIError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                delay = self._retry_delay(method, attempt, e)
+                if delay is None or (
+                    deadline is not None and time.monotonic() + delay >= deadline
+                ):
+                    raise
+                logger.debug(
+                    f"{method} {path} failed ({e!r}), retrying in {delay:.2f}s"
+                )
+            attempt += 1
+            self.stats.retries += 1
+            await asyncio.sleep(delay)
 
         logger.debug(f"{method} {path} successful: {ret}")
 
         return ret
 
+    async def _send_before(self, method, url, body, timeout, deadline):
+        if deadline is None:
+            return await self._send(method, url, body, timeout)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError(f"deadline exceeded for {method} {url}")
+        if timeout is None or timeout > remaining:
+            timeout = remaining
+        # the deadline also bounds time spent waiting for the scheduler
+        return await asyncio.wait_for(self._send(method, url, body, timeout), remaining)
+
+    async def _send(self, method, url, body, timeout):
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+        cache = self.response_cache if method == "GET" and body is None else None
+        cached = cache.get(url) if cache is not None else None
+
+        if body is None:
+            headers = self._headers
+        else:
+            headers = self._auth_json_headers
+            kwargs["data"] = self.json_codec.dumps(body)
+        if cached is not None:
+            headers = cached.conditional_headers(headers)
+
+        async with self.scheduler.slot(urlsplit(url).netloc):
+            r = await self._get_session().request(
+                method, url, headers=headers, **kwargs
+            )
+
+            try:
+                r.raise_for_status()
+            except aiohttp.ClientResponseError as e:
+                raise APIError(e)
+
+            if r.status == 304 and cached is not None:
+                self.stats.not_modified += 1
+                data = cached.body
+            else:
+                # read the body once, whether or not it has a content-length
+                data = await r.read()
+                if cache is not None:
+                    if cached is not None and cached.body == data:
+                        # unchanged, even though the server didn't say so
+                        self.stats.unchanged += 1
+                    cache.put(
+                        url,
+                        CachedResponse(
+                            r.headers.get("ETag"), r.headers.get("Last-Modified"), data
+                        ),
+                    )
+
+        # decode a new value every time, so that callers can't change each
+        # other's (or the cache's)
+        return self.json_codec.loads(data) if data else None
+
+    def _retry_delay(self, method, attempt, error) -> Optional[float]:
+        """Return how long to wait before retrying, or None to give up"""
+
+        if isinstance(error, APIError):
+            status = error.status
+            retry_after = error.retry_after
+        else:
+            # connection error or timeout
+            status = retry_after = None
+        delay = self.retry_policy.delay(method, attempt, status, retry_after)
+        if delay is None:
+            return None
+        if self.retry_budget is not None:
+            if self.retry_budget <= 0:
+                logger.warning("retry budget exhausted, not retrying")
+                return None
+            self.retry_budget -= 1
+        return delay
+
+    def parse_timestamp(self, value: str) -> datetime.datetime:
+        """Parse a timestamp from the API, reusing the result for repeated values
+
+        Most timestamps in a spa's state (e.g. fieldsLastUpdated) are unchanged
+        from one poll to the next, so the parsed datetimes are memoized.
+        """
+        return self._timestamp_cache(value)
+
     async def get_account(self) -> "Account":
         """Retrieve the SmartTub account of the authenticated user"""
 
+        return await self._cache.get("account", self._get_account)
+
+    async def _get_account(self) -> "Account":
         j = await self.request("GET", f"accounts/{self.account_id}")
         account = Account(self, **j)
         logger.debug(f"get_account successful: {j}")
 
         return account
 
+    def invalidate_cache(self, resource: str = None):
+        """Forget the cached account, so that get_account() fetches it again
+
+        resource -- "account", or None (the same)
+
+        Spas are cached by their Account, and pumps, lights and reminders by
+        their Spa: see Account.invalidate_cache() and Spa.invalidate_cache().
+        """
+        self._cache.invalidate(resource)
+
+
+def _copy_json(value):
+    """Copy a decoded JSON value, much faster than copy.deepcopy()"""
+    if isinstance(value, dict):
+        return {k: _copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(v) for v in value]
+    return value
+
+
+def _deadline_kwargs(deadline):
+    # only pass a deadline along when there is one, to keep calls unchanged otherwise
+    return {} if deadline is None else {"deadline": deadline}
+
 
 class Account:
     def __init__(self, api: SmartTub, **properties):
@@ -143,83 +674,577 @@ class Account:
         self.id = properties["id"]
         self.email = properties["email"]
         self.properties = properties
+        self._cache = TTLCache(api.resource_cache_ttl, ("spas", "spa"))
 
     async def get_spas(self):
-        return await asyncio.gather(
-            *[
-                self.get_spa(spa["id"])
-                for spa in (await self._api.request("GET", f"spas?ownerId={self.id}"))[
-                    "content"
-                ]
-            ]
+        return list(await self._cache.get("spas", self._get_spas))
+
+    async def _get_spas(self):
+        return [spa async for spa in self.iter_spas()]
+
+    async def iter_spas(self):
+        """Yield the account's spas, fetching the spa list a page at a time
+
+        Spas are built from the list itself when it has enough detail; use
+        Spa.refresh() to fetch everything else about a spa. Each page's spas
+        are yielded as soon as it arrives, while the next page is fetched.
+        """
+        async for spa_list in self._iter_spa_list():
+            for spa in await asyncio.gather(
+                *[self._spa_from_list(spa) for spa in spa_list]
+            ):
+                yield spa
+
+    async def _iter_spa_list(self):
+        # yield the entries of each page of the spa list, prefetching the next
+        page = 0
+        pending = asyncio.ensure_future(
+            self._api.request("GET", self._spa_list_path(page))
         )
+        try:
+            while pending is not None:
+                spa_list = await pending
+                pending = None
+                if not spa_list.get("last", True):
+                    page += 1
+                    pending = asyncio.ensure_future(
+                        self._api.request("GET", self._spa_list_path(page))
+                    )
+                yield spa_list["content"]
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def _spa_list_path(self, page: int) -> str:
+        path = f"spas?ownerId={self.id}"
+        return f"{path}&page={page}" if page else path
+
+    async def _spa_from_list(self, properties: dict) -> "Spa":
+        if all(key in properties for key in Spa.REQUIRED_PROPERTIES):
+            return Spa(self._api, self, **properties)
+        return await self.get_spa(properties["id"])
 
     async def get_spa(self, spa_id: str):
+        return await self._cache.get("spa", lambda: self._get_spa(spa_id), spa_id)
+
+    async def _get_spa(self, spa_id: str):
         return Spa(self._api, self, **await self._api.request("GET", f"spas/{spa_id}"))
 
+    def invalidate_cache(self, resource: str = None):
+        """Forget cached spas ("spas", "spa" or None for both)"""
+        self._cache.invalidate(resource)
+
+    # default number of spas snapshot() works on at once
+    SNAPSHOT_CONCURRENCY = 10
+
+    async def snapshot(
+        self, max_concurrency: int = SNAPSHOT_CONCURRENCY
+    ) -> "AccountSnapshot":
+        """Fetch the full status, errors and reminders of every spa
+
+        Spas are fetched as soon as each page of the spa list arrives,
+        max_concurrency at a time. A failure only affects the spa concerned: it is recorded in that
+        spa's SpaSnapshot.failures rather than raised.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def snapshot_spa(properties):
+            async with semaphore:
+                return await self._snapshot_spa(properties)
+
+        tasks = []
+        try:
+            async for spa_list in self._iter_spa_list():
+                tasks.extend(
+                    asyncio.ensure_future(snapshot_spa(spa)) for spa in spa_list
+                )
+            spas = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return AccountSnapshot(
+            self, tuple(spas), datetime.datetime.now(datetime.timezone.utc)
+        )
+
+    async def _snapshot_spa(self, properties: dict) -> "SpaSnapshot":
+        spa_id = properties["id"]
+        try:
+            spa = await self._spa_from_list(properties)
+        except Exception as e:
+            logger.warning(f"snapshot of spa {spa_id} failed: {e!r}")
+            return SpaSnapshot(spa_id, None, None, None, None, _failures(spa=e))
+
+        status, errors, reminders = await asyncio.gather(
+            spa.get_status_full(),
+            spa.get_errors(),
+            spa.get_reminders(),
+            return_exceptions=True,
+        )
+        failures = {}
+        for resource, result in (
+            ("status", status),
+            ("errors", errors),
+            ("reminders", reminders),
+        ):
+            if isinstance(result, BaseException):
+                logger.warning(f"snapshot of {resource} for {spa} failed: {result!r}")
+                failures[resource] = result
+        return SpaSnapshot(
+            spa_id,
+            spa,
+            None if "status" in failures else status,
+            None if "errors" in failures else tuple(errors),
+            None if "reminders" in failures else tuple(reminders),
+            _failures(**failures),
+        )
+
+    # default number of spas bulk operations work on at once
+    BULK_CONCURRENCY = 10
+    # statuses which mean the request wasn't processed, so retrying a write
+    # can't repeat it
+    BULK_RETRY_STATUSES = frozenset({429, 503})
+
+    async def iter_bulk(
+        self,
+        operation: Callable,
+        spas=None,
+        max_concurrency: int = BULK_CONCURRENCY,
+        retries: int = 1,
+        retry_delay: float = 1.0,
+        retry_on: tuple = None,
+    ):
+        """Run operation on many spas, yielding a BulkResult as each finishes
+
+        operation -- an async function taking a Spa, e.g.
+            lambda spa: spa.set_heat_mode(Spa.HeatMode.ECONOMY)
+        spas -- the spas to operate on (default: all of the account's spas)
+        max_concurrency -- how many spas to operate on at once
+        retries -- how many more times to try a spa after a failure in
+            retry_on, so operation must be safe to repeat
+        retry_delay -- seconds before the first retry, doubling for each one
+        retry_on -- exception types to retry (default: failures to connect,
+            and API errors with a status in BULK_RETRY_STATUSES)
+
+        Failures are reported in the results rather than raised.
+        """
+        if spas is None:
+            spas = [spa async for spa in self.iter_spas()]
+        if retry_on is None:
+            retryable = self._bulk_retryable
+        else:
+
+            def retryable(error):
+                return isinstance(error, retry_on)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(spa):
+            async with semaphore:
+                return await self._bulk_one(
+                    operation, spa, retries, retry_delay, retryable
+                )
+
+        tasks = [asyncio.ensure_future(run(spa)) for spa in spas]
+        try:
+            for result in asyncio.as_completed(tasks):
+                yield await result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def bulk(self, operation: Callable, spas=None, **kwargs) -> "BulkSummary":
+        """Run operation on many spas and return a summary of the results
+
+        Accepts the same arguments as iter_bulk().
+        """
+        return BulkSummary(
+            tuple(
+                [result async for result in self.iter_bulk(operation, spas, **kwargs)]
+            )
+        )
+
+    def _bulk_retryable(self, error) -> bool:
+        # only retry failures which guarantee the request wasn't processed:
+        # after e.g. a dropped connection, a gateway timeout or a timeout
+        # waiting for a change, the operation may well have taken effect, and
+        # repeating it (e.g. a pump toggle) could undo it
+        if isinstance(error, APIError):
+            return error.status in self.BULK_RETRY_STATUSES
+        return isinstance(error, aiohttp.ClientConnectorError)
+
+    async def _bulk_one(
+        self, operation, spa, retries, retry_delay, retryable
+    ) -> "BulkResult":
+        attempt = 1
+        while True:
+            try:
+                return BulkResult(spa, await operation(spa), None, attempt)
+            except Exception as e:
+                if attempt > retries or not retryable(e):
+                    logger.warning(f"bulk operation on {spa} failed: {e!r}")
+                    return BulkResult(spa, None, e, attempt)
+                delay = retry_delay * 2 ** (attempt - 1)
+                logger.debug(
+                    f"bulk operation on {spa} failed ({e!r}), retrying in {delay}s"
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
     def __str__(self):
         return f"<Account {self.email}>"
 
 
+class _PendingCheck:
+    __slots__ = (
+        "check_func",
+        "future",
+        "end_time",
+        "full",
+        "poll",
+        "attempt",
+        "next_time",
+    )
+
+    def __init__(self, check_func, future, end_time, full, poll):
+        self.check_func = check_func
+        self.future = future
+        self.end_time = end_time
+        self.full = full
+        self.poll = poll
+        self.attempt = 1
+        self.next_time = time.monotonic() + poll.delay(1)
+
+
+class StateConfirmer:
+    """Confirms changes to one spa, with a single polling loop
+
+    Every pending check is evaluated against each state fetched, so several
+    changes waiting at once (e.g. toggling three pumps) share requests
+    instead of polling separately. The full status is fetched if any check
+    needs it. Each check keeps to its own PollStrategy and end time.
+    """
+
+    def __init__(self, spa: "Spa"):
+        self.spa = spa
+        self._checks = []
+        self._task = None
+        self._wakeup = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._checks)
+
+    async def confirm(
+        self, check_func, end_time: float, full: bool, poll
+    ) -> "SpaState":
+        """Wait until check_func accepts a state of the spa, and return it
+
+        Raises StateChangeTimeout if end_time (a time.monotonic() value)
+        passes first. No status request is allowed to run past it.
+        """
+        check = _PendingCheck(
+            check_func,
+            asyncio.get_running_loop().create_future(),
+            end_time,
+            full,
+            poll,
+        )
+        self._checks.append(check)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()
+        try:
+            return await check.future
+        finally:
+            if check in self._checks:
+                self._checks.remove(check)
+
+    async def _run(self):
+        try:
+            await self._poll()
+        finally:
+            # don't leave anyone waiting if polling stops unexpectedly
+            for c in self._checks:
+                c.future.cancel()
+
+    async def _poll(self):
+        while self._checks:
+            now = time.monotonic()
+            expired = [c for c in self._checks if c.end_time <= now]
+            if expired:
+                self._fail(
+                    expired,
+                    StateChangeTimeout(
+                        "State change not reflected within timeout period"
+                    ),
+                )
+                continue
+            next_time = min(min(c.next_time, c.end_time) for c in self._checks)
+            if next_time > now:
+                # sleep until a check is due, or a new one arrives
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_time - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            checks = list(self._checks)
+            if any(c.full for c in checks):
+                get_status = self.spa.get_status_full
+            else:
+                get_status = self.spa.get_status
+            try:
+                # a slow request mustn't hold any check past its end time
+                state = await get_status(deadline=min(c.end_time for c in checks))
+            except asyncio.TimeoutError as e:
+                error = StateChangeTimeout(
+                    "State change not reflected within timeout period"
+                )
+                error.__cause__ = e
+                # if it was someone's end time that ran out, the rest carry on
+                now = time.monotonic()
+                expired = [c for c in checks if c.end_time <= now]
+                self._fail(expired or checks, error)
+                continue
+            except Exception as e:
+                self._fail(checks, e)
+                continue
+
+            now = time.monotonic()
+            for c in checks:
+                if c.future.done():
+                    continue
+                try:
+                    confirmed = c.check_func(state)
+                except Exception as e:
+                    c.future.set_exception(e)
+                    continue
+                if confirmed:
+                    c.future.set_result(state)
+                elif now >= c.end_time:
+                    c.future.set_exception(
+                        StateChangeTimeout(
+                            "State change not reflected within timeout period"
+                        )
+                    )
+                elif now >= c.next_time:
+                    c.attempt += 1
+                    c.next_time = now + c.poll.delay(c.attempt)
+            self._checks = [c for c in self._checks if not c.future.done()]
+
+    def _fail(self, checks, error):
+        for c in checks:
+            if not c.future.done():
+                c.future.set_exception(error)
+        self._checks = [c for c in self._checks if not c.future.done()]
+
+
+class DesiredState(NamedTuple):
+    """Settings for Spa.apply() to bring a spa to; None leaves one unchanged
+
+    pumps -- maps pump ids to True (on) or False (off)
+    lights -- maps light zones to (SpaLight.LightMode, intensity) pairs
+    all_lights -- a (SpaLight.LightMode, intensity) pair for every light the
+        spa has, except zones given in lights
+    """
+
+    set_temperature: Optional[float] = None
+    heat_mode: Optional[Enum] = None
+    temperature_format: Optional[Enum] = None
+    pumps: Optional[Mapping[str, bool]] = None
+    lights: Optional[Mapping[int, tuple]] = None
+    all_lights: Optional[tuple] = None
+
+
+class StateConfirmation:
+    """A change made to a spa, which may not have taken effect yet
+
+    Setters called with wait=False return one of these as soon as the change
+    has been sent. Await it (e.g. with asyncio.gather, for many changes at
+    once) for the confirmed state; StateChangeTimeout is raised if the change
+    isn't seen in time.
+    """
+
+    Status = Enum("Status", "PENDING CONFIRMED TIMED_OUT FAILED")
+
+    def __init__(self, waiter):
+        self._task = asyncio.ensure_future(waiter)
+        self._task.add_done_callback(self._done)
+
+    @staticmethod
+    def _done(task):
+        # nobody may be awaiting the confirmation, so don't warn about errors
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"state change not confirmed: {task.exception()!r}")
+
+    @property
+    def status(self) -> "StateConfirmation.Status":
+        if not self._task.done():
+            return self.Status.PENDING
+        if self._task.cancelled():
+            return self.Status.FAILED
+        error = self._task.exception()
+        if error is None:
+            return self.Status.CONFIRMED
+        if isinstance(error, StateChangeTimeout):
+            return self.Status.TIMED_OUT
+        return self.Status.FAILED
+
+    def done(self) -> bool:
+        return self._task.done()
+
+    def result(self) -> "SpaState":
+        """Return the confirmed state, or raise why it couldn't be confirmed"""
+        return self._task.result()
+
+    def cancel(self):
+        """Stop waiting for confirmation (the change itself is not undone)"""
+        self._task.cancel()
+
+    def __await__(self):
+        return self._task.__await__()
+
+    def __str__(self):
+        return f"<StateConfirmation {self.status.name}>"
+
+
+async def _confirm(waiter, wait: bool):
+    # wait for a change to take effect, or let the caller do so later
+    if wait:
+        await waiter
+        return None
+    return StateConfirmation(waiter)
+
+
+class PollStrategy:
+    """Controls how often a spa is polled while waiting for a change to show
+
+    initial_delay -- seconds to wait before the first check; changes are
+        rarely reflected in the API straight away
+    backoff -- factor by which the wait grows after each check
+    max_delay -- upper bound on the wait between checks
+    timeout -- seconds after which to give up
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = 0.25,
+        backoff: float = 2.0,
+        max_delay: float = 2.0,
+        timeout: float = 10,
+    ):
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    def delay(self, attempt: int) -> float:
+        """Return the wait before check number attempt, starting at 1"""
+
+        return min(self.max_delay, self.initial_delay * self.backoff ** (attempt - 1))
+
+
 class Spa:
     HeatMode = Enum("HeatMode", "ECONOMY DAY AUTO READY REST")
     TemperatureFormat = Enum("TemperatureFormat", "FAHRENHEIT CELSIUS")
     EnergyUsageInterval = Enum("EnergyUsageInterval", "DAY MONTH")
 
+    # properties a Spa can't be created without
+    REQUIRED_PROPERTIES = ("id", "brand", "model")
+    # default polling for setters which wait for their change to take effect
+    POLL_STRATEGY = PollStrategy()
+
     def __init__(self, api: SmartTub, account: Account, **properties):
         self._api = api
         self.account = account
         self.id = properties["id"]
+        self._cache = TTLCache(api.resource_cache_ttl, ("pumps", "lights", "reminders"))
+        self._confirmer = StateConfirmer(self)
+        self._set_properties(properties)
+
+    def _set_properties(self, properties: dict):
         self.brand = properties["brand"]
         self.model = properties["model"]
-        self.properties = properties
+        # responses may be shared with the response cache, so keep our own copy
+        self.properties = properties.copy()
 
         self.name = f"{self.brand} {self.model}"
 
-    async def request(self, method, resource: str, body=None):
-        return await self._api.request(method, f"spas/{self.id}/{resource}", body)
+    async def refresh(self) -> "Spa":
+        """Fetch all of the spa's details
+
+        Spas listed by Account.get_spas() only have the properties included in
+        the spa list.
+        """
+        self._set_properties(await self._api.request("GET", f"spas/{self.id}"))
+        return self
+
+    @property
+    def keep_raw_properties(self) -> bool:
+        return self._api.keep_raw_properties
+
+    async def request(self, method, resource: str, body=None, deadline: float = None):
+        return await self._api.request(
+            method, f"spas/{self.id}/{resource}", body, **_deadline_kwargs(deadline)
+        )
 
     async def _wait_for_state_change(
-        self, check_func, timeout=10, get_status_method=None
+        self,
+        check_func,
+        timeout=None,
+        get_status_method=None,
+        deadline=None,
+        poll=None,
     ):
         """Wait for a state change to be reflected in the API.
 
         Args:
             check_func: A function that takes a SpaState and returns True if the desired state is reached
-            timeout: Maximum time to wait in seconds
-            get_status_method: A method to call to get the current state if needed
+            timeout: Maximum time to wait in seconds (default: poll.timeout)
+            get_status_method: get_status_full if check_func needs lights or pumps (default: get_status)
+            deadline: A time.monotonic() value after which to stop waiting, even if timeout has not elapsed
+            poll: A PollStrategy (default: POLL_STRATEGY)
 
         Returns:
             The final SpaState after the change is complete
 
         Raises:
-            RuntimeError if the state change is not reflected within the timeout period
-        """
-        start_time = datetime.datetime.now().timestamp()
-        while True:
-            state = await self.get_status()
-            if check_func(state):
-                return state
-
-            if datetime.datetime.now().timestamp() - start_time > timeout:
-                raise RuntimeError("State change not reflected within timeout period")
-
-            await asyncio.sleep(0.5)
-
-            if get_status_method:
-                state = await get_status_method()
+            StateChangeTimeout if the state change is not reflected within the timeout period
 
-    async def get_status(self) -> "SpaState":
+        Waits for changes to the same spa share one polling loop (see
+        StateConfirmer).
+        """
+        if poll is None:
+            poll = self.POLL_STRATEGY
+        if timeout is None:
+            timeout = poll.timeout
+        end_time = time.monotonic() + timeout
+        if deadline is not None:
+            end_time = min(end_time, deadline)
+        full = get_status_method is not None and get_status_method != self.get_status
+        return await self._confirmer.confirm(check_func, end_time, full, poll)
+
+    async def get_status(self, deadline: float = None) -> "SpaState":
         """Query the status of the spa."""
-        return SpaState(self, **await self.request("GET", "status"))
+        return SpaState(self, **await self.request("GET", "status", deadline=deadline))
 
     async def get_pumps(self) -> List["SpaPump"]:
+        return list(await self._cache.get("pumps", self._get_pumps))
+
+    async def _get_pumps(self) -> List["SpaPump"]:
         return [
             SpaPump(self, **pump_info)
             for pump_info in (await self.request("GET", "pumps"))["pumps"]
         ]
 
     async def get_lights(self) -> List["SpaLight"]:
+        return list(await self._cache.get("lights", self._get_lights))
+
+    async def _get_lights(self) -> List["SpaLight"]:
         return [
             SpaLight(self, **light_info)
             for light_info in (await self.request("GET", "lights"))["lights"]
@@ -232,20 +1257,19 @@ class Spa:
         ]
 
     async def get_reminders(self) -> List["SpaReminder"]:
+        return list(await self._cache.get("reminders", self._get_reminders))
+
+    async def _get_reminders(self) -> List["SpaReminder"]:
         # API returns both 'reminders' and 'filters', both seem to be identical
         return [
             SpaReminder(self, **reminder_info)
             for reminder_info in (await self.request("GET", "reminders"))["reminders"]
         ]
 
-    async def get_status_full(self) -> "SpaStateFull":
+    async def get_status_full(self, deadline: float = None) -> "SpaStateFull":
         """Retrieves the state of lights and pumps in addition to what get_status does."""
-        full_status = await self.request("GET", "fullStatus")
-        try:
-            return SpaStateFull(self, full_status)
-        except Exception:
-            logger.error(f"Failed to parse fullStatus response: {full_status}")
-            raise
+        full_status = await self.request("GET", "fullStatus", deadline=deadline)
+        return SpaStateFull(self, full_status)
 
     async def get_debug_status(self) -> dict:
         return (await self.request("GET", "debugStatus"))["debugStatus"]
@@ -263,31 +1287,165 @@ class Spa:
         }
         return (await self.request("POST", "energyUsage", body))["buckets"]
 
-    async def set_heat_mode(self, mode: HeatMode):
+    async def set_heat_mode(
+        self,
+        mode: HeatMode,
+        deadline: float = None,
+        poll: PollStrategy = None,
+        wait: bool = True,
+    ):
         body = {"heatMode": mode.name}
-        await self.request("PATCH", "config", body)
-        await self._wait_for_state_change(lambda state: state.heat_mode == mode)
+        await self.request("PATCH", "config", body, deadline=deadline)
+        return await _confirm(
+            self._wait_for_state_change(
+                lambda state: state.heat_mode == mode, deadline=deadline, poll=poll
+            ),
+            wait,
+        )
 
-    async def set_temperature(self, temp_c: float):
+    async def set_temperature(
+        self,
+        temp_c: float,
+        deadline: float = None,
+        poll: PollStrategy = None,
+        wait: bool = True,
+    ):
         body = {
             # responds with 500 if given more than 1 decimal point
             "setTemperature": round(temp_c, 1)
         }
-        await self.request("PATCH", "config", body)
-        await self._wait_for_state_change(
-            lambda state: state.set_temperature == round(temp_c, 1)
+        await self.request("PATCH", "config", body, deadline=deadline)
+        return await _confirm(
+            self._wait_for_state_change(
+                lambda state: state.set_temperature == round(temp_c, 1),
+                deadline=deadline,
+                poll=poll,
+            ),
+            wait,
         )
 
     async def toggle_clearray(self):
         await self.request("POST", "clearray/toggle")
         # No need to wait for state change as this is a toggle operation
 
-    async def set_temperature_format(self, temperature_format: TemperatureFormat):
+    async def set_temperature_format(
+        self,
+        temperature_format: TemperatureFormat,
+        deadline: float = None,
+        poll: PollStrategy = None,
+        wait: bool = True,
+    ):
         body = {"displayTemperatureFormat": temperature_format.name}
-        await self.request("POST", "config", body)
-        await self._wait_for_state_change(
-            lambda state: state.display_temperature_format == temperature_format.name
+        await self.request("POST", "config", body, deadline=deadline)
+        return await _confirm(
+            self._wait_for_state_change(
+                lambda state: state.display_temperature_format
+                == temperature_format.name,
+                deadline=deadline,
+                poll=poll,
+            ),
+            wait,
+        )
+
+    async def apply(
+        self,
+        desired: "DesiredState",
+        deadline: float = None,
+        poll: PollStrategy = None,
+        wait: bool = True,
+        ignore_missing: bool = False,
+    ) -> dict:
+        """Bring the spa to a desired state, changing only what differs
+
+        The current state is fetched once, then the necessary changes are made
+        concurrently and confirmed together. Returns a dict mapping each thing
+        changed (a DesiredState field name, or a SpaPump or SpaLight) to its
+        StateConfirmation; unless wait is False, they are all confirmed first.
+
+        If any change fails (or, when waiting, isn't confirmed), ApplyFailed
+        is raised once the others are done, with the same dict: the other
+        changes have still been made.
+
+        ignore_missing -- skip pumps and lights the spa doesn't have, instead of
+            raising ValueError
+        """
+
+        status = await self.get_status_full(deadline=deadline)
+
+        changes = {}
+        temperature = desired.set_temperature
+        if temperature is not None and status.set_temperature != round(temperature, 1):
+            changes["set_temperature"] = functools.partial(
+                self.set_temperature, temperature
+            )
+        if desired.heat_mode is not None and status.heat_mode != desired.heat_mode:
+            changes["heat_mode"] = functools.partial(
+                self.set_heat_mode, desired.heat_mode
+            )
+        temperature_format = desired.temperature_format
+        if (
+            temperature_format is not None
+            and status.display_temperature_format != temperature_format.name
+        ):
+            changes["temperature_format"] = functools.partial(
+                self.set_temperature_format, temperature_format
+            )
+
+        pumps = {pump.id: pump for pump in status.pumps}
+        for pump_id, on in (desired.pumps or {}).items():
+            pump = pumps.get(pump_id)
+            if pump is None:
+                if ignore_missing:
+                    continue
+                raise ValueError(f"{self} has no pump {pump_id}")
+            if (pump.state != SpaPump.PumpState.OFF) != on:
+                changes[pump] = pump.toggle
+
+        lights = {light.zone: light for light in status.lights}
+        desired_lights = {}
+        if desired.all_lights is not None:
+            desired_lights.update((zone, desired.all_lights) for zone in lights)
+        desired_lights.update(desired.lights or {})
+        for zone, (mode, intensity) in desired_lights.items():
+            light = lights.get(zone)
+            if light is None:
+                if ignore_missing:
+                    continue
+                raise ValueError(f"{self} has no light zone {zone}")
+            if light.mode != mode or light.intensity != intensity:
+                changes[light] = functools.partial(light.set_mode, mode, intensity)
+
+        results = await asyncio.gather(
+            *[
+                change(deadline=deadline, poll=poll, wait=False)
+                for change in changes.values()
+            ],
+            return_exceptions=True,
         )
+        confirmations = {}
+        for target, result in zip(changes, results):
+            if isinstance(result, BaseException):
+                # record the failed change alongside the ones which were made
+                failed = asyncio.get_running_loop().create_future()
+                failed.set_exception(result)
+                result = StateConfirmation(failed)
+            confirmations[target] = result
+        if wait:
+            await asyncio.gather(*confirmations.values(), return_exceptions=True)
+
+        failures = [
+            c
+            for c in confirmations.values()
+            if c.status
+            in (StateConfirmation.Status.FAILED, StateConfirmation.Status.TIMED_OUT)
+        ]
+        if failures:
+            errors = [c._task.exception() for c in failures if not c._task.cancelled()]
+            raise ApplyFailed(
+                f"{len(failures)} of {len(confirmations)} changes to {self} failed",
+                confirmations,
+            ) from (errors[0] if errors else None)
+        return confirmations
 
     async def set_date_time(
         self, date: datetime.date = None, time: datetime.time = None
@@ -305,141 +1463,253 @@ class Spa:
         await self.request("POST", "config", body)
         # No need to wait for state change as this is a one-time operation
 
+    def invalidate_cache(self, resource: str = None):
+        """Forget cached pumps, lights or reminders (or all of them, if resource is None)"""
+        self._cache.invalidate(resource)
+
     def __str__(self):
         return f"<Spa {self.id}>"
 
 
+class _StateField:
+    """A state attribute which is parsed from its JSON property on first access
+
+    Fields are compiled into their class's schema when the class is created,
+    and parsed by SpaState.__getattr__ (see SpaState).
+
+    Arguments:
+        json_key -- a key in the instance's properties map
+        constructor -- a callable which accepts the instance and the raw value, and returns an appropriate internal representation (e.g. enum)
+        default -- the raw value to use if the property is missing
+    """
+
+    __slots__ = ("json_key", "constructor", "default")
+
+    def __init__(self, json_key, constructor=None, default=None):
+        self.json_key = json_key
+        self.constructor = constructor
+        self.default = default
+
+    def parse(self, state):
+        value = state.properties.get(self.json_key, self.default)
+        # if value is None, skip constructor
+        if value is not None and self.constructor is not None:
+            value = self.constructor(state, value)
+        return value
+
+
+def _parse_timestamp(value: str) -> datetime.datetime:
+    """Parse an ISO 8601 timestamp from the API
+
+    The API almost always uses YYYY-MM-DDTHH:MM:SS.sssZ, which
+    datetime.fromisoformat handles much faster than dateutil once the "Z" is
+    spelled as an offset (Python < 3.11 doesn't accept "Z"). Anything else
+    falls back to dateutil.
+    """
+
+    if value[-1:] == "Z":
+        candidate = value[:-1] + "+00:00"
+    else:
+        candidate = value
+    try:
+        return datetime.datetime.fromisoformat(candidate)
+    except ValueError:
+        return dateutil.parser.isoparse(value)
+
+
+def _state_timestamp(state, value):
+    return state.spa._api.parse_timestamp(value)
+
+
+def _state_timestamps(state, timestamps):
+    parse = state.spa._api.parse_timestamp
+    return {k: parse(v) if v is not None else None for k, v in timestamps.items()}
+
+
 class SpaState:
+    """The state of a spa, as returned by the status endpoint
+
+    Attributes are parsed from the raw properties when they are first
+    accessed, so reading one field doesn't pay for parsing all of them.
+
+    Each class's fields are compiled into a schema (attribute name -> field)
+    when the class is created, and taken out of the class namespace. The
+    schema then drives parsing (__getattr__), serialization (to_dict) and
+    introspection (fields). Subclasses inherit their parents' fields unless
+    declared with inherit_fields=False.
+    """
+
     CycleStatus = Enum("CycleStatus", "INACTIVE ACTIVE")
 
+    _schema = MappingProxyType({})
+
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.properties = properties.copy()
-        self._prop("ambientTemperature")
-        self._prop("blowoutCycle", constructor=lambda x: self.CycleStatus[x])
-        self._prop("cleanupCycle", constructor=lambda x: self.CycleStatus[x])
-        self._prop("current")
-        self._prop("date", constructor=dateutil.parser.isoparse)
-        self._prop("demoMode")
-        self._prop("dipSwitches")
-        self._prop("displayTemperatureFormat")
-        self._prop("error")
-        self._prop("errorCode")
-        self._prop(
-            "fieldsLastUpdated",
-            constructor=lambda d: {
-                k: dateutil.parser.isoparse(v) if v is not None else None
-                for k, v in d.items()
-            },
-        )
-        self._prop("flowSwitch")
-        self._prop("heatMode", constructor=lambda x: Spa.HeatMode[x])
-        self._prop("heater")
-        self._prop("highTemperatureLimit")
-        self._prop("lastUpdated", constructor=dateutil.parser.isoparse)
-        self._prop("lights")  # seems to be None even when there are lights?
-        self._prop("location")
-        self._prop(
-            "locks",
-            constructor=lambda x: {
-                k: SpaLock(self.spa, kind=k, state=v) for k, v in x.items()
-            },
-        )
-        self._prop("online")
-        self._prop("ozone")
-        self._prop(
-            "primaryFiltration",
-            constructor=lambda p: SpaPrimaryFiltrationCycle(self.spa, **p),
-        )
-        self._prop(
-            "secondaryFiltration",
-            constructor=lambda p: SpaSecondaryFiltrationCycle(self.spa, **p),
+
+    def __init_subclass__(cls, inherit_fields=True, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile_schema(inherit_fields)
+
+    @classmethod
+    def _compile_schema(cls, inherit_fields=True):
+        schema = dict(cls._schema) if inherit_fields else {}
+        for name, attr in list(vars(cls).items()):
+            if isinstance(attr, _StateField):
+                schema[name] = attr
+                # so that lookups fall through to __getattr__
+                delattr(cls, name)
+        cls._schema = MappingProxyType(schema)
+
+    def __getattr__(self, name):
+        # only called for fields which haven't been parsed yet
+        field = type(self)._schema.get(name)
+        if field is None:
+            raise AttributeError(
+                f"{type(self).__name__!r} object has no attribute {name!r}"
+            )
+        value = field.parse(self)
+        # cache the result, so that later lookups don't reach __getattr__
+        self.__dict__[name] = value
+        return value
+
+    @classmethod
+    def fields(cls) -> MappingProxyType:
+        """Map each attribute name to the JSON property it is parsed from"""
+        return MappingProxyType(
+            {name: field.json_key for name, field in cls._schema.items()}
         )
-        self._prop("setTemperature")
-        self._prop("state")
-        self._prop("time", constructor=datetime.time.fromisoformat)
-        self._prop("timeFormat")
-        self._prop("timeSet")  # ?
-        self._prop("timezone")  # ?
-        self._prop("uv")
-        self._prop("uvOnDemand")
-        self._prop("versions")
-        self._prop("water", constructor=lambda p: SpaWaterState(self.spa, **p))
-        self._prop("watercare")
-
-    def _prop(
-        self,
-        json_key,
-        instance_variable_name=None,
-        constructor=None,
-    ):
-        """Set an instance variable corresponding to the specified JSON property
 
-        Arguments:
-            json_key -- a key in the self.properties map
-            instance_variable_name -- the name of the variable to set
-            constructor -- a callable which accepts the raw value as an argument, and returns an appropriate internal representation (e.g. enum)
-        """
+    def to_dict(self) -> dict:
+        """Return every field as plain data, keyed by attribute name
 
-        if instance_variable_name is None:
-            instance_variable_name = underscore(json_key)
-        if json_key in self.properties:
-            if constructor is None:
-                setattr(self, instance_variable_name, self.properties[json_key])
-            else:
-                # if value is None, skip constructor
-                if self.properties[json_key] is None:
-                    setattr(self, instance_variable_name, None)
-                else:
-                    setattr(
-                        self,
-                        instance_variable_name,
-                        constructor(self.properties[json_key]),
-                    )
-        else:
-            setattr(self, instance_variable_name, None)
+        Nested states (e.g. water) and models (e.g. pumps) become dicts,
+        enums become their names and timestamps become ISO 8601 strings.
+        """
+        return {name: _state_to_plain(getattr(self, name)) for name in self._schema}
+
+    ambient_temperature = _StateField("ambientTemperature")
+    blowout_cycle = _StateField("blowoutCycle", lambda state, x: state.CycleStatus[x])
+    cleanup_cycle = _StateField("cleanupCycle", lambda state, x: state.CycleStatus[x])
+    current = _StateField("current")
+    date = _StateField("date", _state_timestamp)
+    demo_mode = _StateField("demoMode")
+    dip_switches = _StateField("dipSwitches")
+    display_temperature_format = _StateField("displayTemperatureFormat")
+    error = _StateField("error")
+    error_code = _StateField("errorCode")
+    fields_last_updated = _StateField("fieldsLastUpdated", _state_timestamps)
+    flow_switch = _StateField("flowSwitch")
+    heat_mode = _StateField("heatMode", lambda state, x: Spa.HeatMode[x])
+    heater = _StateField("heater")
+    high_temperature_limit = _StateField("highTemperatureLimit")
+    last_updated = _StateField("lastUpdated", _state_timestamp)
+    lights = _StateField("lights")  # seems to be None even when there are lights?
+    location = _StateField("location")
+    locks = _StateField(
+        "locks",
+        lambda state, x: {k: SpaLock(state.spa, kind=k, state=v) for k, v in x.items()},
+    )
+    online = _StateField("online")
+    ozone = _StateField("ozone")
+    primary_filtration = _StateField(
+        "primaryFiltration",
+        lambda state, p: SpaPrimaryFiltrationCycle(state.spa, **p),
+    )
+    secondary_filtration = _StateField(
+        "secondaryFiltration",
+        lambda state, p: SpaSecondaryFiltrationCycle(state.spa, **p),
+    )
+    set_temperature = _StateField("setTemperature")
+    state = _StateField("state")
+    time = _StateField("time", lambda state, x: datetime.time.fromisoformat(x))
+    time_format = _StateField("timeFormat")
+    time_set = _StateField("timeSet")  # ?
+    timezone = _StateField("timezone")  # ?
+    uv = _StateField("uv")
+    uv_on_demand = _StateField("uvOnDemand")
+    versions = _StateField("versions")
+    water = _StateField("water", lambda state, p: SpaWaterState(state.spa, **p))
+    watercare = _StateField("watercare")
 
     def __str__(self):
         return f"<{self.__class__.__name__}: {self.properties}>"
 
 
+SpaState._compile_schema()
+
+
+def _state_to_plain(value):
+    if isinstance(value, SpaState):
+        return value.to_dict()
+    if isinstance(value, (SpaPump, SpaLight, SpaLock, SpaSensor)):
+        return {
+            name: _state_to_plain(getattr(value, name))
+            for name in value.__slots__
+            if name not in ("spa", "properties")
+        }
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, list):
+        return [_state_to_plain(item) for item in value]
+    if isinstance(value, dict):
+        return {k: _state_to_plain(v) for k, v in value.items()}
+    return value
+
+
 class SpaStateFull(SpaState):
+    # fields which are parsed lazily, but must be present
+    REQUIRED_PROPERTIES = ("lights", "pumps")
+
     def __init__(self, spa: Spa, state: dict):
+        for key in self.REQUIRED_PROPERTIES:
+            if not isinstance(state.get(key), list):
+                raise KeyError(f"fullStatus response has no {key} list: {state}")
         super().__init__(spa, **state)
-        self.lights = [
-            SpaLight(spa, **light_props) for light_props in self.properties["lights"]
-        ]
-        self.pumps = [
-            SpaPump(spa, **pump_props) for pump_props in self.properties["pumps"]
-        ]
-        self.sensors = [
-            SpaSensor(spa, **sensor_props)
-            for sensor_props in self.properties.get("sensors", [])
-        ]
+
+    lights = _StateField(
+        "lights",
+        lambda state, lights: [
+            SpaLight(state.spa, **light_props) for light_props in lights
+        ],
+    )
+    pumps = _StateField(
+        "pumps",
+        lambda state, pumps: [SpaPump(state.spa, **pump_props) for pump_props in pumps],
+    )
+    sensors = _StateField(
+        "sensors",
+        lambda state, sensors: [
+            SpaSensor(state.spa, **sensor_props) for sensor_props in sensors
+        ],
+        default=(),
+    )
 
 
-class SpaWaterState(SpaState):
+class SpaWaterState(SpaState, inherit_fields=False):
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.properties = properties.copy()
 
-        self._prop("temperature")
-        self._prop("temperatureLastUpdated", constructor=dateutil.parser.isoparse)
+    temperature = _StateField("temperature")
+    temperature_last_updated = _StateField("temperatureLastUpdated", _state_timestamp)
 
 
-class SpaPrimaryFiltrationCycle(SpaState):
+class SpaPrimaryFiltrationCycle(SpaState, inherit_fields=False):
     PrimaryFiltrationMode = Enum("PrimaryFiltrationMode", "NORMAL NANO_MODE")
 
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.properties = properties.copy()
 
-        self._prop("cycle")
-        self._prop("duration")
-        self._prop("lastUpdated", constructor=dateutil.parser.isoparse)
-        self._prop("mode", constructor=lambda x: self.PrimaryFiltrationMode[x])
-        self._prop("startHour")
-        self._prop("status", constructor=lambda x: self.CycleStatus[x])
+    cycle = _StateField("cycle")
+    duration = _StateField("duration")
+    last_updated = _StateField("lastUpdated", _state_timestamp)
+    mode = _StateField("mode", lambda state, x: state.PrimaryFiltrationMode[x])
+    start_hour = _StateField("startHour")
+    status = _StateField("status", lambda state, x: state.CycleStatus[x])
 
     async def set(self, cycle=None, duration=None, mode=None, start_hour=None):
         body = {
@@ -453,7 +1723,7 @@ class SpaPrimaryFiltrationCycle(SpaState):
         await self.spa.request("PATCH", "config", body)
 
 
-class SpaSecondaryFiltrationCycle(SpaState):
+class SpaSecondaryFiltrationCycle(SpaState, inherit_fields=False):
     SecondaryFiltrationMode = Enum(
         "SecondaryFiltrationMode", "AWAY FREQUENT INFREQUENT"
     )
@@ -462,9 +1732,9 @@ class SpaSecondaryFiltrationCycle(SpaState):
         self.spa = spa
         self.properties = properties.copy()
 
-        self._prop("lastUpdated", constructor=dateutil.parser.isoparse)
-        self._prop("mode", constructor=lambda x: self.SecondaryFiltrationMode[x])
-        self._prop("status", constructor=lambda x: self.CycleStatus[x])
+    last_updated = _StateField("lastUpdated", _state_timestamp)
+    mode = _StateField("mode", lambda state, x: state.SecondaryFiltrationMode[x])
+    status = _StateField("status", lambda state, x: state.CycleStatus[x])
 
     async def set_mode(self, mode: SecondaryFiltrationMode):
         body = {"secondaryFiltrationConfig": mode.name}
@@ -475,25 +1745,37 @@ class SpaPump:
     PumpState = Enum("PumpState", "OFF LOW HIGH")
     PumpType = Enum("PumpType", "BLOWER CIRCULATION JET")
 
+    __slots__ = ("spa", "id", "speed", "state", "type", "properties")
+
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.id = properties["id"]
         self.speed = properties["speed"]
         self.state = self.PumpState[properties["state"]]
         self.type = self.PumpType[properties["type"]]
-        self.properties = properties
+        self.properties = properties if spa.keep_raw_properties else None
 
-    async def toggle(self):
+    async def toggle(
+        self, deadline: float = None, poll: PollStrategy = None, wait: bool = True
+    ):
         # For toggle, we need to wait for the state to change from its current state
         current_state = self.state
-        await self.spa.request("POST", f"pumps/{self.id}/toggle")
-        await self.spa._wait_for_state_change(
-            lambda state: any(
-                pump.state != current_state
-                for pump in state.pumps
-                if pump.id == self.id
+        await self.spa.request(
+            "POST", f"pumps/{self.id}/toggle", **_deadline_kwargs(deadline)
+        )
+        self.spa.invalidate_cache("pumps")
+        return await _confirm(
+            self.spa._wait_for_state_change(
+                lambda state: any(
+                    pump.state != current_state
+                    for pump in state.pumps
+                    if pump.id == self.id
+                ),
+                get_status_method=self.spa.get_status_full,
+                deadline=deadline,
+                poll=poll,
             ),
-            get_status_method=self.spa.get_status_full,
+            wait,
         )
 
     def __str__(self):
@@ -506,6 +1788,18 @@ class SpaLight:
         "PURPLE ORANGE RED YELLOW GREEN AQUA BLUE WHITE AMBER HIGH_SPEED_COLOR_WHEEL HIGH_SPEED_WHEEL LOW_SPEED_WHEEL FULL_DYNAMIC_RGB AUTO_TIMER_EXTERIOR PARTY COLOR_WHEEL OFF ON",
     )
 
+    __slots__ = (
+        "spa",
+        "zone",
+        "red",
+        "green",
+        "blue",
+        "white",
+        "intensity",
+        "mode",
+        "properties",
+    )
+
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.zone = properties["zone"]
@@ -518,33 +1812,62 @@ class SpaLight:
 
         self.intensity = properties["intensity"]
         self.mode = self.LightMode[properties["mode"]]
-        self.properties = properties
+        self.properties = properties if spa.keep_raw_properties else None
 
-    async def set_mode(self, mode: LightMode, intensity: int):
+    async def set_mode(
+        self,
+        mode: LightMode,
+        intensity: int,
+        deadline: float = None,
+        poll: PollStrategy = None,
+        wait: bool = True,
+    ):
         assert (intensity == 0) == (mode == self.LightMode.OFF)
 
         body = {
             "intensity": intensity,
             "mode": mode.name,
         }
-        await self.spa.request("PATCH", f"lights/{self.zone}", body)
-        await self.spa._wait_for_state_change(
-            lambda state: any(
-                light.mode == mode and light.intensity == intensity
-                for light in state.lights
-                if light.zone == self.zone
+        await self.spa.request(
+            "PATCH", f"lights/{self.zone}", body, **_deadline_kwargs(deadline)
+        )
+        self.spa.invalidate_cache("lights")
+        return await _confirm(
+            self.spa._wait_for_state_change(
+                lambda state: any(
+                    light.mode == mode and light.intensity == intensity
+                    for light in state.lights
+                    if light.zone == self.zone
+                ),
+                get_status_method=self.spa.get_status_full,
+                deadline=deadline,
+                poll=poll,
             ),
-            get_status_method=self.spa.get_status_full,
+            wait,
         )
 
-    async def turn_off(self):
-        await self.set_mode(self.LightMode.OFF, 0)
+    async def turn_off(
+        self, deadline: float = None, poll: PollStrategy = None, wait: bool = True
+    ):
+        return await self.set_mode(
+            self.LightMode.OFF, 0, deadline=deadline, poll=poll, wait=wait
+        )
 
     def __str__(self):
         return f"<SpaLight {self.zone}: {self.mode.name} (R {self.red}/G {self.green}/B {self.blue}/W {self.white}) @ {self.intensity}>"
 
 
 class SpaReminder:
+    __slots__ = (
+        "spa",
+        "id",
+        "name",
+        "remaining_days",
+        "snoozed",
+        "state",
+        "last_updated",
+    )
+
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.id = properties["id"]
@@ -556,28 +1879,41 @@ class SpaReminder:
 
         last_updated_str = properties.get("lastUpdated")
         if last_updated_str is not None:
-            self.last_updated = dateutil.parser.isoparse(last_updated_str)
+            self.last_updated = _parse_timestamp(last_updated_str)
 
     async def snooze(self, days: int):
         body = {"remainingDuration": days}
         await self.spa.request("PATCH", f"reminders/{self.id}", body)
+        self.spa.invalidate_cache("reminders")
 
     async def reset(self, days: int):
         body = {"remainingDuration": days, "reset": True}
         await self.spa.request("PATCH", f"reminders/{self.id}", body)
+        self.spa.invalidate_cache("reminders")
 
     def __str__(self):
         return f"<SpaReminder {self.id}: {self.state}/{self.remaining_days}/{self.snoozed}>"
 
 
 class SpaError:
+    __slots__ = (
+        "spa",
+        "code",
+        "title",
+        "description",
+        "created_at",
+        "updated_at",
+        "active",
+        "error_type",
+    )
+
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.code = properties["code"]
         self.title = properties["title"]
         self.description = properties["description"]
-        self.created_at = dateutil.parser.isoparse(properties["createdAt"])
-        self.updated_at = dateutil.parser.isoparse(properties["updatedAt"])
+        self.created_at = _parse_timestamp(properties["createdAt"])
+        self.updated_at = _parse_timestamp(properties["updatedAt"])
         self.active = properties["active"]
         self.error_type = properties["errorType"]
 
@@ -588,6 +1924,8 @@ class SpaError:
 class SpaLock:
     CODE = "0772"
 
+    __slots__ = ("spa", "kind", "state")
+
     def __init__(self, spa: Spa, kind: str, state: str):
         self.spa = spa
         self.kind = kind
@@ -620,6 +1958,18 @@ class SpaLock:
 
 
 class SpaSensor:
+    __slots__ = (
+        "spa",
+        "address",
+        "name",
+        "type",
+        "subType",
+        "magnet",
+        "pressure",
+        "motion",
+        "fill_drain",
+    )
+
     def __init__(self, spa: Spa, **properties):
         self.spa = spa
         self.address = properties["address"]
@@ -636,9 +1986,521 @@ class SpaSensor:
         return f"<SpaSensor {self.name} ({self.type})"
 
 
+def _failures(**failures) -> Mapping[str, BaseException]:
+    return MappingProxyType(failures)
+
+
+class SpaSnapshot(NamedTuple):
+    """The state of one spa, as fetched by Account.snapshot()
+
+    Resources which could not be fetched are None, and the exception raised
+    fetching them is in failures (keyed by "spa", "status", "errors" or
+    "reminders").
+    """
+
+    spa_id: str
+    spa: Optional[Spa]
+    status: Optional[SpaStateFull]
+    errors: Optional[tuple]
+    reminders: Optional[tuple]
+    failures: Mapping[str, BaseException]
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+
+class AccountSnapshot(NamedTuple):
+    """The state of every spa in an account at (about) the same time"""
+
+    account: Account
+    spas: tuple
+    taken_at: datetime.datetime
+
+    @property
+    def ok(self) -> bool:
+        return all(spa.ok for spa in self.spas)
+
+    @property
+    def failed(self) -> tuple:
+        return tuple(spa for spa in self.spas if not spa.ok)
+
+    def get(self, spa_id: str) -> Optional[SpaSnapshot]:
+        for spa in self.spas:
+            if spa.spa_id == spa_id:
+                return spa
+        return None
+
+
+class BulkResult(NamedTuple):
+    """The outcome of a bulk operation on one spa"""
+
+    spa: Spa
+    # what the operation returned, if it succeeded
+    result: Any
+    error: Optional[BaseException]
+    attempts: int
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class BulkSummary(NamedTuple):
+    """The outcome of a bulk operation on every spa it was run on"""
+
+    results: tuple
+
+    @property
+    def ok(self) -> bool:
+        return all(result.ok for result in self.results)
+
+    @property
+    def succeeded(self) -> tuple:
+        return tuple(result for result in self.results if result.ok)
+
+    @property
+    def failed(self) -> tuple:
+        return tuple(result for result in self.results if not result.ok)
+
+    def __str__(self):
+        return (
+            f"<BulkSummary {len(self.succeeded)} succeeded,"
+            f" {len(self.failed)} failed>"
+        )
+
+
+class JSONCodec:
+    """Encodes request bodies and decodes response bodies, using the json module"""
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """A faster JSONCodec, using orjson"""
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: bytes):
+        return orjson.loads(data)
+
+
+def default_json_codec() -> JSONCodec:
+    return OrjsonCodec() if orjson is not None else JSONCodec()
+
+
+class TTLCache:
+    """Holds slow-changing resources for a limited time
+
+    Arguments:
+        ttl -- a mapping of resource name to the number of seconds to keep it;
+               resources with no (or zero) TTL are always fetched
+        resources -- the resources this cache holds, if only some of those in
+               ttl; invalidating any other raises ValueError
+    """
+
+    def __init__(self, ttl: Mapping[str, float], resources=None):
+        self.ttl = ttl
+        self.resources = frozenset(ttl if resources is None else resources)
+        self._entries = {}
+        # bumped by invalidate(), so that a fetch racing with it isn't stored
+        self._generation = 0
+
+    async def get(self, resource: str, fetch: Callable, *key):
+        """Return the cached value of resource, or await fetch() for a new one
+
+        key -- distinguishes several values of the same resource (e.g. spa ids)
+        """
+        ttl = self.ttl.get(resource)
+        if not ttl:
+            return await fetch()
+        cache_key = (resource, *key)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        generation = self._generation
+        value = await fetch()
+        if generation == self._generation:
+            self._entries[cache_key] = (time.monotonic() + ttl, value)
+        return value
+
+    def invalidate(self, resource: str = None):
+        if resource is not None and resource not in self.resources:
+            raise ValueError(f"{resource!r} is not one of {sorted(self.resources)}")
+        self._generation += 1
+        if resource is None:
+            self._entries.clear()
+        else:
+            for cache_key in [k for k in self._entries if k[0] == resource]:
+                del self._entries[cache_key]
+
+
+class _InflightRequest(NamedTuple):
+    task: asyncio.Future
+    # the limits the request was made with
+    timeout: float
+    deadline: Optional[float]
+
+    def covers(self, timeout: float, deadline: Optional[float]) -> bool:
+        """Whether a caller with these limits can wait for this request
+
+        A request made with tighter limits might time out when the caller's
+        own request wouldn't.
+        """
+        if self.timeout < timeout:
+            return False
+        if self.deadline is None:
+            return True
+        return deadline is not None and self.deadline >= deadline
+
+
+class CachedResponse(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # the raw response body
+    body: bytes
+
+    def conditional_headers(self, headers: Mapping) -> Mapping:
+        if self.etag is None and self.last_modified is None:
+            return headers
+        headers = dict(headers)
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """Remembers recent GET responses, so that unchanged ones can be reused
+
+    Requests for a cached URL are made conditional on the validators (ETag,
+    Last-Modified) of the previous response, and a 304 Not Modified response
+    is answered from the previous body, without transferring it again. The
+    body is decoded afresh for every caller, so callers may modify what
+    SmartTub.request() returns.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+
+    def put(self, url: str, entry: CachedResponse):
+        self._entries[url] = entry
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RetryPolicy:
+    """Controls which failed requests are retried, and when
+
+    max_attempts -- attempts per request, including the first (1 disables retries)
+    backoff_base -- the first retry waits up to this many seconds
+    backoff_max -- upper bound on the wait between attempts; a longer
+        Retry-After from the server causes the request to fail instead
+    retry_statuses -- HTTP statuses which are retried
+    methods -- HTTP methods which are retried; by default only idempotent ones
+    budget -- total retries allowed per session (None for no limit)
+    """
+
+    RETRY_STATUSES = frozenset({429, 502, 503, 504})
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        retry_statuses=RETRY_STATUSES,
+        methods=IDEMPOTENT_METHODS,
+        budget: int = None,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = frozenset(retry_statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.budget = budget
+
+    def delay(
+        self, method: str, attempt: int, status: int = None, retry_after: float = None
+    ) -> Optional[float]:
+        """Return the delay before retrying a failed attempt, or None to give up
+
+        method -- the HTTP method of the request
+        attempt -- the number of the attempt which failed, starting at 1
+        status -- the HTTP status, or None if no response was received
+        retry_after -- the value of the response's Retry-After header, in seconds
+        """
+
+        if attempt >= self.max_attempts or method.upper() not in self.methods:
+            return None
+        if status is not None and status not in self.retry_statuses:
+            return None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.backoff_max else None
+        # exponential backoff with full jitter
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        )
+
+
+class RequestStats:
+    """Counters describing the requests made through a SmartTub instance"""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        # GET responses answered from the response cache after a 304 Not
+        # Modified, and ones whose body was identical to the cached one
+        self.not_modified = 0
+        self.unchanged = 0
+        # GETs which shared the result of an identical request in progress
+        self.coalesced = 0
+        # requests currently waiting for the scheduler
+        self.queued = 0
+        self.max_queued = 0
+        self.in_flight = 0
+        # seconds spent waiting for the scheduler
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def mean_wait_time(self) -> float:
+        return self.total_wait_time / self.requests if self.requests else 0.0
+
+    def __str__(self):
+        return (
+            f"<RequestStats requests={self.requests} retries={self.retries}"
+            f" coalesced={self.coalesced}"
+            f" queued={self.queued}"
+            f" in_flight={self.in_flight} mean_wait={self.mean_wait_time:.3f}s>"
+        )
+
+
+class TokenBucket:
+    """Rate limiter allowing rate requests per second, with bursts of up to burst"""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # reserve a token now, and wait for it to be earned if we're in debt;
+        # this queues waiters in arrival order
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class RequestScheduler:
+    """Limits concurrency (per host) and rate of requests to the API
+
+    max_concurrent -- simultaneous requests allowed per host (None for no limit)
+    rate -- requests per second allowed across all hosts (None for no limit)
+    burst -- requests allowed in a burst before rate limiting applies
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = None,
+        rate: float = None,
+        burst: int = None,
+        stats: RequestStats = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.stats = stats or RequestStats()
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._semaphores = {}
+
+    def _semaphore(self, host) -> Optional[asyncio.Semaphore]:
+        if self.max_concurrent is None:
+            return None
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphores[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host: str):
+        """Wait for permission to send a request to host"""
+
+        stats = self.stats
+        semaphore = self._semaphore(host)
+        start = time.monotonic()
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        try:
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                if self._bucket is not None:
+                    await self._bucket.acquire()
+            except BaseException:
+                if semaphore is not None:
+                    semaphore.release()
+                raise
+        finally:
+            stats.queued -= 1
+
+        wait_time = time.monotonic() - start
+        stats.requests += 1
+        stats.total_wait_time += wait_time
+        stats.max_wait_time = max(stats.max_wait_time, wait_time)
+        stats.in_flight += 1
+        try:
+            yield
+        finally:
+            stats.in_flight -= 1
+            if semaphore is not None:
+                semaphore.release()
+
+
+class TokenStore(abc.ABC):
+    """Persists SmartTub credentials so that later sessions can skip login
+
+    Subclasses implement load(), save() and clear(). The stored value is a dict
+    with username, account_id, access_token and refresh_token keys. SmartTub
+    treats errors from load() and save() as a cache miss.
+    """
+
+    @abc.abstractmethod
+    def load(self) -> Optional[dict]:
+        pass
+
+    @abc.abstractmethod
+    def save(self, tokens: dict):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+
+class FileTokenStore(TokenStore):
+    """Stores tokens in a JSON file, readable only by the current user
+
+    Writes are atomic, and a lock file serializes access from concurrent
+    processes (e.g. overlapping cron jobs).
+    """
+
+    DEFAULT_PATH = "~/.cache/smarttub/tokens.json"
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = os.path.expanduser(path)
+
+    @contextlib.contextmanager
+    def _locked(self, create=True):
+        if create:
+            os.makedirs(os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self) -> Optional[dict]:
+        if not os.path.isdir(os.path.dirname(self.path) or "."):
+            return None
+        with self._locked(create=False):
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return None
+            except ValueError as e:
+                logger.warning(f"ignoring corrupt token file {self.path}: {e}")
+                return None
+
+    def save(self, tokens: dict):
+        with self._locked():
+            # mkstemp creates the file with mode 0600
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path) or ".", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(tokens, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def clear(self):
+        with self._locked():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
 class LoginFailed(RuntimeError):
     pass
 
 
-class APIError(RuntimeError):
+class StateChangeTimeout(RuntimeError):
     pass
+
+
+class ApplyFailed(RuntimeError):
+    """Some of the changes made by Spa.apply() failed
+
+    confirmations -- maps every change made or attempted to its
+        StateConfirmation, whose status says how it went
+    """
+
+    def __init__(self, message: str, confirmations: dict):
+        super().__init__(message)
+        self.confirmations = confirmations
+
+
+class APIError(RuntimeError):
+    @property
+    def status(self) -> Optional[int]:
+        """The HTTP status of the failed response, if any"""
+        return getattr(self.args[0], "status", None) if self.args else None
+
+    @property
+    def retry_after(self) -> Optional[float]:
+        """The delay requested by the Retry-After response header, in seconds"""
+
+        headers = getattr(self.args[0], "headers", None) if self.args else None
+        value = headers.get("Retry-After") if headers else None
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when.timestamp() - time.time())
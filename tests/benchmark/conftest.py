@@ -0,0 +1,10 @@
+import sys
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def no_tracer():
+    # timings are meaningless under a tracer such as coverage
+    if sys.gettrace() is not None:
+        pytest.skip("benchmarks don't run under a tracer (e.g. --cov)")
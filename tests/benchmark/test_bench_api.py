@@ -0,0 +1,74 @@
+"""Microbenchmarks for per-request overhead in SmartTub
+
+Each benchmark compares a fast path against the slower code it replaced, and
+only asserts on the relative cost of the two.
+"""
+
+import time
+import timeit
+
+import jwt
+import pytest
+
+import smarttub
+from tests.test_spa import canonical_full_status
+
+pytestmark = pytest.mark.benchmark
+
+ITERATIONS = 20000
+
+
+def best_of(func, number=ITERATIONS, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+@pytest.fixture(name="api")
+def api():
+    api = smarttub.SmartTub(session=object())
+    api._set_access_token(
+        jwt.encode(
+            {api.AUTH_ACCOUNT_ID_KEY: "account_id1", "exp": time.time() + 3600},
+            "secret" * 6,
+        )
+    )
+    return api
+
+
+class BaselineHeaders:
+    """SmartTub._headers as it was, building the headers for every request"""
+
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+    @property
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+
+def test_bench_request_headers(api):
+    baseline = BaselineHeaders(api.access_token)
+
+    def uncached():
+        return baseline._headers
+
+    def cached():
+        return api._headers
+
+    assert cached() == uncached()
+    uncached_time = best_of(uncached)
+    cached_time = best_of(cached)
+    print(f"headers: uncached={uncached_time:.4f}s cached={cached_time:.4f}s")
+    assert cached_time < uncached_time
+
+
+def test_bench_decode_full_status():
+    pytest.importorskip("orjson")
+    data = smarttub.JSONCodec().dumps(canonical_full_status())
+    stdlib = smarttub.JSONCodec()
+    fast = smarttub.OrjsonCodec()
+
+    assert fast.loads(data) == stdlib.loads(data)
+    stdlib_time = best_of(lambda: stdlib.loads(data), number=1000)
+    fast_time = best_of(lambda: fast.loads(data), number=1000)
+    print(f"fullStatus decode: json={stdlib_time:.4f}s orjson={fast_time:.4f}s")
+    assert fast_time < stdlib_time
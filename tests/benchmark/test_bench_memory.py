@@ -0,0 +1,87 @@
+"""Memory benchmarks for holding a fleet's worth of spa state"""
+
+import gc
+import tracemalloc
+
+import pytest
+
+import smarttub
+from tests.test_spa import canonical_full_status
+
+pytestmark = pytest.mark.benchmark
+
+SPAS = 10000
+
+
+def retained_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        objects = build()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del objects
+    return size
+
+
+def full_statuses():
+    # decoded separately for each spa, as they would be from real responses
+    codec = smarttub.default_json_codec()
+    data = codec.dumps(canonical_full_status())
+    return [codec.loads(data) for _ in range(SPAS)]
+
+
+@pytest.fixture(name="api")
+def api():
+    return smarttub.SmartTub(session=object())
+
+
+@pytest.fixture(name="spa")
+def spa(api):
+    return smarttub.Spa(api, None, id="id1", brand="brand1", model="model1")
+
+
+def test_bench_memory_full_status(spa, monkeypatch):
+    statuses = full_statuses()
+
+    def build():
+        states = [smarttub.SpaStateFull(spa, status) for status in statuses]
+        for state in states:
+            state.pumps, state.lights, state.sensors, state.locks
+        return states
+
+    slotted = retained_memory(build)
+
+    # the same models with a __dict__ per instance, as before
+    for name in ["SpaPump", "SpaLight", "SpaLock"]:
+        cls = getattr(smarttub.api, name)
+        monkeypatch.setattr(smarttub.api, name, type(name, (cls,), {}))
+    unslotted = retained_memory(build)
+
+    print(
+        f"{SPAS} fullStatus snapshots: {unslotted / 2**20:.1f}MiB with __dict__,"
+        f" {slotted / 2**20:.1f}MiB with __slots__"
+    )
+    assert slotted < unslotted
+
+
+def test_bench_memory_models(spa, api):
+    # pumps and lights kept without the state (and raw response) they came from
+    def build():
+        models = []
+        for status in full_statuses():
+            models.extend(smarttub.SpaPump(spa, **p) for p in status["pumps"])
+            models.extend(smarttub.SpaLight(spa, **light) for light in status["lights"])
+        return models
+
+    keep = retained_memory(build)
+    api.keep_raw_properties = False
+    drop = retained_memory(build)
+
+    print(
+        f"pumps and lights for {SPAS} spas: {keep / 2**20:.1f}MiB with raw properties,"
+        f" {drop / 2**20:.1f}MiB without"
+    )
+    assert drop < keep
@@ -0,0 +1,170 @@
+"""Benchmarks for parsing spa state"""
+
+import datetime
+import re
+import timeit
+
+import dateutil.parser
+import pytest
+
+import smarttub
+from tests.test_spa import canonical_full_status
+
+pytestmark = pytest.mark.benchmark
+
+ITERATIONS = 500
+
+
+def best_of(func, number=ITERATIONS, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+@pytest.fixture(name="spa")
+def spa(mock_api):
+    return smarttub.Spa(mock_api, None, id="id1", brand="brand1", model="model1")
+
+
+def underscore(word):
+    # inflection.underscore, which the eager parser used
+    word = re.sub(r"([A-Z]+)([A-Z][a-z])", r"\1_\2", word)
+    word = re.sub(r"([a-z\d])([A-Z])", r"\1_\2", word)
+    return word.replace("-", "_").lower()
+
+
+class EagerState:
+    """The parser which SpaState replaced: every field, on every instance"""
+
+    def __init__(self, spa, **properties):
+        self.spa = spa
+        self.properties = properties.copy()
+
+    def _prop(self, json_key, constructor=None):
+        value = self.properties.get(json_key)
+        if value is not None and constructor is not None:
+            value = constructor(value)
+        setattr(self, underscore(json_key), value)
+
+
+class EagerSpaStateFull(EagerState):
+    def __init__(self, spa, state):
+        super().__init__(spa, **state)
+        CycleStatus = smarttub.SpaState.CycleStatus
+        isoparse = dateutil.parser.isoparse
+        self._prop("ambientTemperature")
+        self._prop("blowoutCycle", constructor=lambda x: CycleStatus[x])
+        self._prop("cleanupCycle", constructor=lambda x: CycleStatus[x])
+        self._prop("current")
+        self._prop("date", constructor=isoparse)
+        self._prop("demoMode")
+        self._prop("dipSwitches")
+        self._prop("displayTemperatureFormat")
+        self._prop("error")
+        self._prop("errorCode")
+        self._prop(
+            "fieldsLastUpdated",
+            constructor=lambda d: {
+                k: isoparse(v) if v is not None else None for k, v in d.items()
+            },
+        )
+        self._prop("flowSwitch")
+        self._prop("heatMode", constructor=lambda x: smarttub.Spa.HeatMode[x])
+        self._prop("heater")
+        self._prop("highTemperatureLimit")
+        self._prop("lastUpdated", constructor=isoparse)
+        self._prop("location")
+        self._prop(
+            "locks",
+            constructor=lambda x: {
+                k: smarttub.SpaLock(spa, kind=k, state=v) for k, v in x.items()
+            },
+        )
+        self._prop("online")
+        self._prop("ozone")
+        self._prop("primaryFiltration", constructor=lambda p: EagerFilter(spa, **p))
+        self._prop("secondaryFiltration", constructor=lambda p: EagerFilter(spa, **p))
+        self._prop("setTemperature")
+        self._prop("state")
+        self._prop("time", constructor=datetime.time.fromisoformat)
+        self._prop("timeFormat")
+        self._prop("timeSet")
+        self._prop("timezone")
+        self._prop("uv")
+        self._prop("uvOnDemand")
+        self._prop("versions")
+        self._prop("water", constructor=lambda p: EagerWater(spa, **p))
+        self._prop("watercare")
+        self.lights = [smarttub.SpaLight(spa, **p) for p in self.properties["lights"]]
+        self.pumps = [smarttub.SpaPump(spa, **p) for p in self.properties["pumps"]]
+        self.sensors = [
+            smarttub.SpaSensor(spa, **p) for p in self.properties.get("sensors", [])
+        ]
+
+
+class EagerWater(EagerState):
+    def __init__(self, spa, **properties):
+        super().__init__(spa, **properties)
+        self._prop("temperature")
+        self._prop("temperatureLastUpdated", constructor=dateutil.parser.isoparse)
+
+
+class EagerFilter(EagerState):
+    def __init__(self, spa, **properties):
+        super().__init__(spa, **properties)
+        self._prop("cycle")
+        self._prop("duration")
+        self._prop("lastUpdated", constructor=dateutil.parser.isoparse)
+        self._prop("mode")
+        self._prop("startHour")
+        self._prop("status", constructor=lambda x: smarttub.SpaState.CycleStatus[x])
+
+
+@pytest.fixture(name="full_status")
+def full_status():
+    full_status = canonical_full_status()
+    full_status["fieldsLastUpdated"] = {
+        f"field{i}": "2021-02-21T21:32:36.215Z" for i in range(12)
+    }
+    return full_status
+
+
+def test_bench_parse_full_status(spa, full_status):
+    fields = smarttub.SpaStateFull.fields()
+
+    def parse_eager():
+        return EagerSpaStateFull(spa, full_status)
+
+    def parse_schema():
+        # every field, as the eager parser did
+        state = smarttub.SpaStateFull(spa, full_status)
+        for name in fields:
+            getattr(state, name)
+        return state
+
+    def read_temperature():
+        return smarttub.SpaStateFull(spa, full_status).water.temperature
+
+    eager, parsed = parse_eager(), parse_schema()
+    for name in fields:
+        assert hasattr(eager, name), name
+    assert eager.water.temperature == parsed.water.temperature == read_temperature()
+    assert eager.last_updated == parsed.last_updated
+
+    eager_time = best_of(parse_eager)
+    schema_time = best_of(parse_schema)
+    lazy_time = best_of(read_temperature)
+    print(
+        f"fullStatus: eager {ITERATIONS / eager_time:.0f}/s,"
+        f" schema (all fields) {ITERATIONS / schema_time:.0f}/s,"
+        f" schema (water.temperature) {ITERATIONS / lazy_time:.0f}/s"
+    )
+    assert schema_time * 1.2 < eager_time
+    assert lazy_time * 10 < eager_time
+
+
+def test_bench_parse_timestamp():
+    value = "2021-02-21T21:32:36.215Z"
+    assert smarttub.api._parse_timestamp(value) == dateutil.parser.isoparse(value)
+    dateutil_time = best_of(lambda: dateutil.parser.isoparse(value), number=10000)
+    fast_time = best_of(lambda: smarttub.api._parse_timestamp(value), number=10000)
+    print(f"timestamps: dateutil={dateutil_time:.4f}s fast path={fast_time:.4f}s")
+    assert fast_time < dateutil_time
@@ -4,13 +4,15 @@ import pytest
 
 import smarttub
 
-
 ACCOUNT_ID = "account_id1"
 
 
 @pytest.fixture
 def mock_api():
     api = create_autospec(smarttub.SmartTub, instance=True)
+    api.parse_timestamp.side_effect = smarttub.api._parse_timestamp
+    api.resource_cache_ttl = dict(smarttub.SmartTub.RESOURCE_CACHE_TTL)
+    api.retry_policy = smarttub.RetryPolicy()
     return api
 
 
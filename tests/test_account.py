@@ -1,3 +1,6 @@
+import asyncio
+
+import aiohttp
 import pytest
 
 import smarttub
@@ -23,3 +26,233 @@ async def test_get_spas(mock_api, account):
     assert len(spas) == 1
     spa = spas[0]
     assert spa.id == "sid1"
+
+
+async def test_get_spas_cached(mock_api, account):
+    mock_api.request.side_effect = [
+        {"content": [{"id": "sid1"}]},
+        {"id": "sid1", "brand": "brand1", "model": "model1"},
+    ]
+    spas = await account.get_spas()
+    assert await account.get_spas() == spas
+    assert await account.get_spa("sid1") is spas[0]
+    assert mock_api.request.call_count == 2
+    with pytest.raises(ValueError):
+        account.invalidate_cache("pumps")
+
+
+async def test_snapshot(mock_api, account):
+    async def request(method, path, body=None):
+        if path == "spas?ownerId=id1":
+            return {"content": [{"id": "sid1"}, {"id": "sid2"}, {"id": "sid3"}]}
+        if path in ("spas/sid1", "spas/sid2"):
+            return {"id": path[5:], "brand": "brand1", "model": "model1"}
+        if path == "spas/sid3":
+            raise smarttub.APIError("not found")
+        if path == "spas/sid2/errors":
+            raise smarttub.APIError("unavailable")
+        if path.endswith("/fullStatus"):
+            return {"state": "NORMAL", "lights": [], "pumps": []}
+        if path.endswith("/errors"):
+            return {"content": []}
+        if path.endswith("/reminders"):
+            return {"reminders": []}
+        raise AssertionError(path)
+
+    mock_api.request.side_effect = request
+    snapshot = await account.snapshot(max_concurrency=1)
+
+    assert snapshot.account is account
+    assert [spa.spa_id for spa in snapshot.spas] == ["sid1", "sid2", "sid3"]
+    assert not snapshot.ok
+    assert [spa.spa_id for spa in snapshot.failed] == ["sid2", "sid3"]
+
+    sid1 = snapshot.get("sid1")
+    assert sid1.ok
+    assert sid1.spa.id == "sid1"
+    assert sid1.status.state == "NORMAL"
+    assert sid1.errors == ()
+    assert sid1.reminders == ()
+
+    sid2 = snapshot.get("sid2")
+    assert sid2.status.state == "NORMAL"
+    assert sid2.errors is None
+    assert isinstance(sid2.failures["errors"], smarttub.APIError)
+
+    sid3 = snapshot.get("sid3")
+    assert sid3.spa is None
+    assert list(sid3.failures) == ["spa"]
+    assert snapshot.get("sid4") is None
+
+
+async def test_get_spas_from_list(mock_api, account):
+    mock_api.request.side_effect = [
+        {"content": [{"id": "sid1", "brand": "brand1", "model": "model1"}]},
+    ]
+    spas = await account.get_spas()
+    assert [spa.name for spa in spas] == ["brand1 model1"]
+    mock_api.request.assert_called_once_with("GET", "spas?ownerId=id1")
+
+
+async def test_iter_spas_pages(mock_api, account):
+    mock_api.request.side_effect = [
+        {
+            "content": [{"id": "sid1", "brand": "brand1", "model": "model1"}],
+            "last": False,
+        },
+        {"content": [{"id": "sid2"}], "last": True},
+        {"id": "sid2", "brand": "brand2", "model": "model2"},
+    ]
+    spas = [spa async for spa in account.iter_spas()]
+    assert [spa.id for spa in spas] == ["sid1", "sid2"]
+    assert spas[1].brand == "brand2"
+    assert [call.args[1] for call in mock_api.request.call_args_list] == [
+        "spas?ownerId=id1",
+        "spas?ownerId=id1&page=1",
+        "spas/sid2",
+    ]
+
+
+def spa_page(*spa_ids, last=True):
+    return {
+        "content": [
+            {"id": spa_id, "brand": "brand1", "model": "model1"} for spa_id in spa_ids
+        ],
+        "last": last,
+    }
+
+
+async def test_iter_spas_prefetch(mock_api, account):
+    requested = []
+
+    async def request(method, path, body=None):
+        requested.append(path)
+        return {
+            "spas?ownerId=id1": spa_page("sid1", last=False),
+            "spas?ownerId=id1&page=1": spa_page("sid2", last=False),
+            "spas?ownerId=id1&page=2": spa_page("sid3"),
+        }[path]
+
+    mock_api.request.side_effect = request
+    async for spa in account.iter_spas():
+        if spa.id == "sid1":
+            # the next page is on its way while we work on this one
+            await asyncio.sleep(0)
+            assert requested[-1] == "spas?ownerId=id1&page=1"
+        if spa.id == "sid2":
+            break
+    await asyncio.sleep(0)
+    assert len(requested) == 3
+
+
+async def test_snapshot_pages(mock_api, account):
+    async def request(method, path, body=None):
+        if path == "spas?ownerId=id1":
+            return spa_page("sid1", last=False)
+        if path == "spas?ownerId=id1&page=1":
+            return spa_page("sid2")
+        if path.endswith("/fullStatus"):
+            return {"lights": [], "pumps": []}
+        if path.endswith("/errors"):
+            return {"content": []}
+        return {"reminders": []}
+
+    mock_api.request.side_effect = request
+    snapshot = await account.snapshot()
+    assert snapshot.ok
+    assert [spa.spa_id for spa in snapshot.spas] == ["sid1", "sid2"]
+
+
+def api_error(status):
+    return smarttub.APIError(
+        aiohttp.ClientResponseError(None, (), status=status, message="error")
+    )
+
+
+async def test_bulk(mock_api, account):
+    mock_api.request.side_effect = [spa_page("sid1", "sid2", "sid3")]
+    attempts = {}
+    active = 0
+    max_active = 0
+
+    async def operation(spa):
+        nonlocal active, max_active
+        attempts[spa.id] = attempts.get(spa.id, 0) + 1
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.001)
+        active -= 1
+        if spa.id == "sid2" and attempts[spa.id] == 1:
+            raise api_error(503)
+        if spa.id == "sid3":
+            raise ValueError("not retried")
+        return spa.id
+
+    summary = await account.bulk(operation, max_concurrency=2, retry_delay=0)
+    assert max_active == 2
+    assert not summary.ok
+    assert str(summary)
+    assert sorted(result.result for result in summary.succeeded) == ["sid1", "sid2"]
+    assert [result.spa.id for result in summary.failed] == ["sid3"]
+    assert isinstance(summary.failed[0].error, ValueError)
+    assert attempts == {"sid1": 1, "sid2": 2, "sid3": 1}
+
+
+async def test_iter_bulk_streams(account):
+    spas = [
+        smarttub.Spa(account._api, account, id=spa_id, brand="b", model="m")
+        for spa_id in ("slow", "fast")
+    ]
+
+    async def operation(spa):
+        await asyncio.sleep(0.05 if spa.id == "slow" else 0)
+        return spa.id
+
+    results = [result async for result in account.iter_bulk(operation, spas)]
+    # results arrive in the order they finish
+    assert [result.result for result in results] == ["fast", "slow"]
+    assert all(result.ok and result.attempts == 1 for result in results)
+
+
+async def test_bulk_retries(mock_api, account):
+    errors = {
+        "s503": api_error(503),
+        "s429": api_error(429),
+        "sconnect": aiohttp.ClientConnectorError(None, OSError("refused")),
+        "s404": api_error(404),
+        "s502": api_error(502),
+        "s504": api_error(504),
+        "stimeout": smarttub.StateChangeTimeout("not confirmed"),
+        "sdisconnect": aiohttp.ServerDisconnectedError(),
+    }
+    mock_api.request.side_effect = [spa_page(*errors)]
+    attempts = {}
+
+    async def operation(spa):
+        attempts[spa.id] = attempts.get(spa.id, 0) + 1
+        raise errors[spa.id]
+
+    summary = await account.bulk(operation, retries=2, retry_delay=0)
+    assert not summary.succeeded
+    results = {result.spa.id: result for result in summary.failed}
+    # failures which mean the request wasn't processed are retried until the
+    # retries run out
+    for spa_id in ("s503", "s429", "sconnect"):
+        assert results[spa_id].attempts == 3
+        assert results[spa_id].error is errors[spa_id]
+    # the rest can't succeed, or may have taken effect already
+    for spa_id in ("s404", "s502", "s504", "stimeout", "sdisconnect"):
+        assert results[spa_id].attempts == 1
+    assert sum(attempts.values()) == 3 * 3 + 5
+
+
+async def test_bulk_retry_on(mock_api, account):
+    mock_api.request.side_effect = [spa_page("sid1")]
+
+    async def operation(spa):
+        raise smarttub.StateChangeTimeout("not confirmed")
+
+    summary = await account.bulk(
+        operation, retry_delay=0, retry_on=(smarttub.StateChangeTimeout,)
+    )
+    assert summary.failed[0].attempts == 2
@@ -1,4 +1,7 @@
+import asyncio
 import aiohttp
+import os
+import threading
 import time
 
 import jwt
@@ -11,6 +14,12 @@ ACCOUNT_ID = "account_id1"
 pytestmark = pytest.mark.asyncio
 
 
+def make_token(exp):
+    return jwt.encode(
+        {smarttub.SmartTub.AUTH_ACCOUNT_ID_KEY: ACCOUNT_ID, "exp": exp}, "secret"
+    )
+
+
 @pytest.fixture(name="unauthenticated_api")
 async def unauthenticated_api(aresponses):
     async with aiohttp.ClientSession() as session:
@@ -62,6 +71,614 @@ async def test_refresh_token(api, aresponses):
     assert response.get("status") == "OK"
 
 
+async def test_cached_token_headers(api, aresponses):
+    headers = api._headers
+    assert headers["Authorization"] == f"Bearer {api.access_token}"
+    assert api._headers is headers
+    with pytest.raises(TypeError):
+        api.access_token_data["exp"] = 0
+
+    api.token_expires_at = time.time()
+    aresponses.add(response={"access_token": make_token(time.time() + 3601)})
+    aresponses.add(response={"status": "OK"})
+    await api.request("GET", "/")
+    assert api._headers is not headers
+    assert api._headers["Authorization"] == f"Bearer {api.access_token}"
+
+
+async def test_refresh_token_single_flight(api, aresponses):
+    now = time.time()
+    api.token_expires_at = now
+    aresponses.add(
+        response={
+            "access_token": jwt.encode(
+                {api.AUTH_ACCOUNT_ID_KEY: ACCOUNT_ID, "exp": now + 3601},
+                "secret",
+            ),
+        }
+    )
+    for _ in range(5):
+        aresponses.add(response={"status": "OK"})
+    responses = await asyncio.gather(*[api.request("GET", f"{i}") for i in range(5)])
+    assert all(response.get("status") == "OK" for response in responses)
+    assert api.token_expires_at > now
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_refresh_token_skew(api, aresponses):
+    now = time.time()
+    api.token_expires_at = now + api.token_refresh_skew - 1
+    aresponses.add(
+        response={
+            "access_token": jwt.encode(
+                {api.AUTH_ACCOUNT_ID_KEY: ACCOUNT_ID, "exp": now + 3601},
+                "secret",
+            ),
+        }
+    )
+    aresponses.add(response={"status": "OK"})
+    await api.request("GET", "/")
+    assert api.token_expires_at == pytest.approx(now + 3601)
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_token_refresher(api, aresponses):
+    now = time.time()
+    api.token_expires_at = now
+    aresponses.add(response=aresponses.Response(status=500))
+    aresponses.add(
+        response={
+            "access_token": jwt.encode(
+                {api.AUTH_ACCOUNT_ID_KEY: ACCOUNT_ID, "exp": now + 3601},
+                "secret",
+            ),
+        }
+    )
+
+    refreshes = []
+    refreshed = asyncio.Event()
+
+    def on_refresh(elapsed, error):
+        refreshes.append(error)
+        if error is None:
+            refreshed.set()
+
+    task = api.start_token_refresher(jitter=0, min_backoff=0, on_refresh=on_refresh)
+    with pytest.raises(RuntimeError):
+        api.start_token_refresher()
+    await asyncio.wait_for(refreshed.wait(), 5)
+
+    assert len(refreshes) == 2
+    assert isinstance(refreshes[0], aiohttp.ClientResponseError)
+    assert refreshes[1] is None
+    assert api.token_expires_at > now
+
+    await api.stop_token_refresher()
+    assert task.cancelled()
+    await api.stop_token_refresher()
+
+
+async def test_token_refresh_delay(api, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    api.token_expires_at = now + 100
+    # always before expiry, between lead_time and lead_time + jitter
+    monkeypatch.setattr(smarttub.api.random, "uniform", lambda a, b: b)
+    assert api._token_refresh_delay(10, 30) == pytest.approx(100 - 10 - 30)
+    monkeypatch.setattr(smarttub.api.random, "uniform", lambda a, b: a)
+    assert api._token_refresh_delay(10, 30) == pytest.approx(100 - 10)
+
+
+async def test_token_refresher_min_interval(api, aresponses, monkeypatch):
+    # tokens which expire sooner than the lead time
+    aresponses.add(response={"access_token": make_token(time.time() + 5)})
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        raise asyncio.CancelledError
+
+    refreshes = []
+    api.token_expires_at = time.time()
+    monkeypatch.setattr(smarttub.api.asyncio, "sleep", sleep)
+    task = api.start_token_refresher(
+        lead_time=60, on_refresh=lambda *args: refreshes.append(args)
+    )
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert len(refreshes) == 1
+    assert sleeps == [30]
+
+
+async def test_token_refresher_not_logged_in(unauthenticated_api):
+    with pytest.raises(RuntimeError):
+        unauthenticated_api.start_token_refresher()
+
+
+@pytest.fixture(name="token_store")
+def token_store(tmp_path):
+    return smarttub.FileTokenStore(str(tmp_path / "cache" / "tokens.json"))
+
+
+async def test_token_store_login_and_resume(token_store, aresponses):
+    aresponses.add(
+        response={
+            "access_token": make_token(time.time() + 3600),
+            "token_type": "Bearer",
+            "refresh_token": "refresh1",
+        }
+    )
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=token_store)
+        await api.login("username1", "password1")
+    saved = token_store.load()
+    assert saved["username"] == "username1"
+    assert saved["account_id"] == ACCOUNT_ID
+    assert saved["refresh_token"] == "refresh1"
+
+    # no network access needed to resume
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=token_store)
+        await api.login("username1", "password1")
+        assert api.logged_in is True
+        assert api.account_id == ACCOUNT_ID
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_token_store_resume_expired(token_store, aresponses):
+    token_store.save(
+        {
+            "username": "username1",
+            "account_id": ACCOUNT_ID,
+            "access_token": make_token(time.time() - 1),
+            "refresh_token": "refresh1",
+        }
+    )
+    aresponses.add(
+        response={
+            "access_token": make_token(time.time() + 3600),
+            "refresh_token": "refresh2",
+        }
+    )
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=token_store)
+        assert await api.resume() is True
+    assert token_store.load()["refresh_token"] == "refresh2"
+
+
+async def test_token_store_resume_refresh_failed(token_store, aresponses):
+    token_store.save(
+        {
+            "username": "username1",
+            "account_id": ACCOUNT_ID,
+            "access_token": make_token(time.time() - 1),
+            "refresh_token": "refresh1",
+        }
+    )
+    aresponses.add(response=aresponses.Response(status=403))
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=token_store)
+        assert await api.resume() is False
+        assert api.logged_in is False
+
+
+async def test_token_store_resume_falls_back(token_store, aresponses):
+    token_store.save(
+        {
+            "username": "username1",
+            "account_id": ACCOUNT_ID,
+            "access_token": make_token(time.time() - 1),
+            "refresh_token": "refresh1",
+        }
+    )
+    # a malformed refresh response, then the password grant
+    aresponses.add(response={"token_type": "Bearer"})
+    aresponses.add(
+        response={
+            "access_token": make_token(time.time() + 3600),
+            "token_type": "Bearer",
+            "refresh_token": "refresh2",
+        }
+    )
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=token_store)
+        await api.login("username1", "password1")
+        assert api.logged_in is True
+    assert token_store.load()["refresh_token"] == "refresh2"
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_token_store_resume_timeout(token_store, monkeypatch):
+    token_store.save(
+        {
+            "username": "username1",
+            "account_id": ACCOUNT_ID,
+            "access_token": make_token(time.time() - 1),
+            "refresh_token": "refresh1",
+        }
+    )
+
+    async def refresh_token():
+        raise asyncio.TimeoutError
+
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=token_store)
+        monkeypatch.setattr(api, "_refresh_token", refresh_token)
+        assert await api.resume() is False
+        assert api.logged_in is False
+
+
+async def test_token_store_save_off_loop(aresponses):
+    class RecordingTokenStore(smarttub.TokenStore):
+        def __init__(self):
+            self.threads = []
+
+        def load(self):
+            return None
+
+        def save(self, tokens):
+            self.threads.append(threading.get_ident())
+
+        def clear(self):
+            pass
+
+    aresponses.add(
+        response={
+            "access_token": make_token(time.time() + 3600),
+            "token_type": "Bearer",
+            "refresh_token": "refresh1",
+        }
+    )
+    store = RecordingTokenStore()
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=store)
+        await api.login("username1", "password1")
+    assert len(store.threads) == 1
+    assert store.threads[0] != threading.get_ident()
+
+
+async def test_token_store_resume_unusable(token_store, aresponses):
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session)
+        with pytest.raises(RuntimeError):
+            await api.resume()
+
+        api = smarttub.SmartTub(session, token_store=token_store)
+        assert await api.resume() is False
+
+        token_store.save({"username": "username2"})
+        assert await api.resume("username1") is False
+        assert await api.resume() is False
+
+        with open(token_store.path, "w") as f:
+            f.write("not json")
+        assert await api.resume() is False
+
+        token_store.clear()
+        token_store.clear()
+        assert token_store.load() is None
+
+
+async def test_token_store_atomic_write(token_store, monkeypatch):
+    token_store.save({"username": "username1"})
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(smarttub.api.os, "replace", fail)
+    with pytest.raises(OSError):
+        token_store.save({"username": "username2"})
+    assert token_store.load() == {"username": "username1"}
+    assert sorted(os.listdir(os.path.dirname(token_store.path))) == [
+        "tokens.json",
+        "tokens.json.lock",
+    ]
+
+
+async def test_token_store_interface():
+    with pytest.raises(TypeError):
+        smarttub.TokenStore()
+
+
+async def test_token_store_failures(tmp_path, aresponses):
+    class BrokenTokenStore(smarttub.TokenStore):
+        def load(self):
+            raise OSError("unreadable")
+
+        def save(self, tokens):
+            raise OSError("read-only")
+
+        def clear(self):
+            pass
+
+    aresponses.add(
+        response={
+            "access_token": make_token(time.time() + 3600),
+            "token_type": "Bearer",
+            "refresh_token": "refresh1",
+        }
+    )
+    aresponses.add(
+        response={
+            "access_token": make_token(time.time() + 3600),
+            "refresh_token": "refresh2",
+        }
+    )
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(session, token_store=BrokenTokenStore())
+        assert await api.resume() is False
+        # the store is a cache, so login and refresh carry on without it
+        await api.login("username1", "password1")
+        assert api.logged_in is True
+        await api._refresh_token_shared()
+        assert api.refresh_token == "refresh2"
+
+    # a path which can't be created is just an empty store
+    store = smarttub.FileTokenStore(str(tmp_path / "missing" / "tokens.json"))
+    assert store.load() is None
+    assert not os.path.exists(tmp_path / "missing")
+    async with aiohttp.ClientSession() as session:
+        api = smarttub.SmartTub(
+            session,
+            token_store=smarttub.FileTokenStore("/proc/nonexistent/tokens.json"),
+        )
+        assert await api.resume() is False
+
+
+async def test_max_concurrent_requests(api, aresponses):
+    api.scheduler.max_concurrent = 2
+    active = 0
+    max_active = 0
+
+    async def handler(request):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return aresponses.Response(
+            text='{"status": "OK"}', content_type="application/json"
+        )
+
+    for _ in range(6):
+        aresponses.add(response=handler)
+    await asyncio.gather(*[api.request("GET", f"{i}") for i in range(6)])
+
+    assert max_active == 2
+    assert api.stats.requests == 6
+    assert api.stats.queued == 0
+    assert api.stats.max_queued == 4
+    assert api.stats.in_flight == 0
+    assert api.stats.max_wait_time > 0
+    assert api.stats.mean_wait_time > 0
+    assert str(api.stats)
+
+
+async def test_rate_limit():
+    scheduler = smarttub.RequestScheduler(rate=100, burst=2)
+    start = time.monotonic()
+    for _ in range(5):
+        async with scheduler.slot("host"):
+            pass
+    # 2 requests are allowed immediately, the other 3 are spaced 10ms apart
+    assert time.monotonic() - start >= 0.025
+    assert scheduler.stats.requests == 5
+
+
+async def test_scheduler_cancelled_while_rate_limited():
+    scheduler = smarttub.RequestScheduler(max_concurrent=1, rate=1, burst=1)
+    async with scheduler.slot("host"):
+        pass
+
+    async def wait():
+        async with scheduler.slot("host"):
+            pass  # pragma: no cover
+
+    task = asyncio.ensure_future(wait())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert scheduler.stats.queued == 0
+    assert scheduler._semaphores["host"].locked() is False
+
+
+async def test_scheduler_unlimited():
+    scheduler = smarttub.RequestScheduler()
+    assert smarttub.RequestStats().mean_wait_time == 0.0
+    async with scheduler.slot("host"):
+        assert scheduler.stats.in_flight == 1
+    assert scheduler._semaphores == {}
+
+
+async def test_retry(api, aresponses):
+    api.retry_policy = smarttub.RetryPolicy(backoff_base=0)
+    aresponses.add(response=aresponses.Response(status=503))
+    aresponses.add(
+        response=aresponses.Response(status=429, headers={"Retry-After": "0"})
+    )
+    aresponses.add(response={"status": "OK"})
+    response = await api.request("GET", "/")
+    assert response == {"status": "OK"}
+    assert api.stats.retries == 2
+
+    for _ in range(3):
+        aresponses.add(response=aresponses.Response(status=503))
+    with pytest.raises(smarttub.APIError):
+        await api.request("GET", "/")
+    assert api.stats.retries == 4
+
+
+async def test_retry_not_idempotent(api, aresponses):
+    aresponses.add(response=aresponses.Response(status=503))
+    with pytest.raises(smarttub.APIError) as exc_info:
+        await api.request("POST", "/", {})
+    assert exc_info.value.status == 503
+    assert api.stats.retries == 0
+
+
+async def test_retry_connection_error(api, aresponses, monkeypatch):
+    api.retry_policy = smarttub.RetryPolicy(backoff_base=0)
+    request = api._get_session().request
+    calls = []
+
+    async def flaky_request(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise aiohttp.ClientConnectionError()
+        return await request(*args, **kwargs)
+
+    monkeypatch.setattr(api._get_session(), "request", flaky_request)
+    aresponses.add(response={"status": "OK"})
+    assert await api.request("GET", "/") == {"status": "OK"}
+    assert len(calls) == 2
+
+
+async def test_retry_budget(api, aresponses):
+    api.retry_policy = smarttub.RetryPolicy(backoff_base=0)
+    api.retry_budget = 1
+    for _ in range(3):
+        aresponses.add(response=aresponses.Response(status=502))
+    with pytest.raises(smarttub.APIError):
+        await api.request("GET", "/")
+    assert api.retry_budget == 0
+    assert api.stats.retries == 1
+
+
+async def test_retry_policy():
+    policy = smarttub.RetryPolicy(max_attempts=3, backoff_base=1, backoff_max=10)
+    assert policy.delay("POST", 1, 503) is None
+    assert policy.delay("GET", 1, 500) is None
+    assert policy.delay("GET", 3, 503) is None
+    assert 0 <= policy.delay("GET", 2, 503) <= 2
+    assert 0 <= policy.delay("get", 1) <= 1
+    assert policy.delay("GET", 1, 429, retry_after=5) == 5
+    assert policy.delay("GET", 1, 429, retry_after=60) is None
+
+
+async def test_api_error_retry_after():
+    def error(headers):
+        return smarttub.APIError(
+            aiohttp.ClientResponseError(None, (), status=429, headers=headers)
+        )
+
+    assert smarttub.APIError().status is None
+    assert smarttub.APIError().retry_after is None
+    assert error({}).retry_after is None
+    assert error({"Retry-After": "7"}).retry_after == 7
+    assert error({"Retry-After": "garbage"}).retry_after is None
+    assert error({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}).retry_after == 0
+    future = time.time() + 100
+    retry_after = error(
+        {"Retry-After": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(future))}
+    ).retry_after
+    assert 90 < retry_after <= 100
+
+
+async def test_request_timeout(api, aresponses):
+    api.retry_policy = smarttub.RetryPolicy(max_attempts=1)
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return aresponses.Response(status=200)  # pragma: no cover
+
+    aresponses.add(response=slow)
+    with pytest.raises(asyncio.TimeoutError):
+        await api.request("GET", "/", timeout=0.01)
+
+
+async def test_request_deadline(api, aresponses):
+    with pytest.raises(asyncio.TimeoutError):
+        await api.request("GET", "/", deadline=time.monotonic())
+
+    aresponses.add(response={"status": "OK"})
+    response = await api.request("GET", "/", deadline=time.monotonic() + 10)
+    assert response == {"status": "OK"}
+
+    # no time to retry before the deadline
+    aresponses.add(
+        response=aresponses.Response(status=503, headers={"Retry-After": "5"})
+    )
+    with pytest.raises(smarttub.APIError):
+        await api.request("GET", "/", deadline=time.monotonic() + 1)
+    assert api.stats.retries == 0
+
+
+async def test_owned_session(aresponses):
+    async with smarttub.SmartTub(keepalive_timeout=15, dns_cache_ttl=60) as api:
+        session = api._get_session()
+        assert isinstance(session.connector, aiohttp.TCPConnector)
+        assert session.connector.limit == api.MAX_CONCURRENT_REQUESTS
+        assert api._get_session() is session
+
+        aresponses.add(
+            response={
+                "access_token": make_token(time.time() + 3600),
+                "token_type": "Bearer",
+                "refresh_token": "refresh1",
+            }
+        )
+        await api.login("username1", "password1")
+        api.start_token_refresher()
+    assert session.closed
+    assert api._refresher_task is None
+
+
+async def test_borrowed_session():
+    async with aiohttp.ClientSession() as session:
+        async with smarttub.SmartTub(session) as api:
+            assert api._get_session() is session
+        assert not session.closed
+
+
+async def test_custom_connector():
+    connector = aiohttp.TCPConnector(limit=3)
+    api = smarttub.SmartTub(connector=connector)
+    assert api._get_session().connector is connector
+    await api.close()
+    assert connector.closed
+
+
+async def test_request_body(api, aresponses):
+    async def handler(request):
+        assert request.headers["Content-Type"] == "application/json"
+        assert request.headers["Authorization"] == f"Bearer {api.access_token}"
+        assert await request.json() == {"setTemperature": 38.3}
+        return aresponses.Response(status=200)
+
+    aresponses.add(response=handler)
+    assert await api.request("PATCH", "/", {"setTemperature": 38.3}) is None
+
+
+async def test_json_codec(monkeypatch):
+    codec = smarttub.JSONCodec()
+    data = codec.dumps({"a": [1, None, "b"]})
+    assert data == b'{"a":[1,null,"b"]}'
+    assert codec.loads(data) == {"a": [1, None, "b"]}
+
+    monkeypatch.setattr(smarttub.api, "orjson", None)
+    assert type(smarttub.default_json_codec()) is smarttub.JSONCodec
+
+
+async def test_orjson_codec():
+    pytest.importorskip("orjson")
+    codec = smarttub.default_json_codec()
+    assert isinstance(codec, smarttub.OrjsonCodec)
+    data = codec.dumps({"a": [1, None, "b"]})
+    assert data == b'{"a":[1,null,"b"]}'
+    assert codec.loads(data) == {"a": [1, None, "b"]}
+
+
+async def test_parse_timestamp_memoized():
+    api = smarttub.SmartTub(session=object(), timestamp_cache_size=2)
+    first = api.parse_timestamp("2021-02-21T21:32:36.215Z")
+    assert api.parse_timestamp("2021-02-21T21:32:36.215Z") is first
+    api.parse_timestamp("2021-02-22T21:32:36.215Z")
+    api.parse_timestamp("2021-02-23T21:32:36.215Z")
+    assert api.parse_timestamp("2021-02-21T21:32:36.215Z") is not first
+    assert api._timestamp_cache.cache_info().currsize == 2
+
+
 async def test_get_account(api, aresponses):
     aresponses.add(
         response={
@@ -90,3 +707,200 @@ async def test_request(api, aresponses):
     aresponses.add(response=aresponses.Response(text=None, status=200))
     response = await api.request("GET", "/")
     assert response is None
+
+
+async def test_conditional_request(api, aresponses):
+    def not_modified(request):
+        assert request.headers["If-None-Match"] == '"v1"'
+        assert request.headers["If-Modified-Since"] == "Sun, 21 Feb 2021 21:32:36 GMT"
+        return aresponses.Response(status=304)
+
+    aresponses.add(
+        response=aresponses.Response(
+            text='{"state": "NORMAL"}',
+            content_type="application/json",
+            headers={"ETag": '"v1"', "Last-Modified": "Sun, 21 Feb 2021 21:32:36 GMT"},
+        )
+    )
+    aresponses.add(response=not_modified)
+
+    first = await api.request("GET", "spas/id1/status")
+    assert first == {"state": "NORMAL"}
+    # changing a response doesn't affect the cached one
+    first["state"] = "ALERT"
+    assert await api.request("GET", "spas/id1/status") == {"state": "NORMAL"}
+    assert api.stats.not_modified == 1
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_unchanged_response(api, aresponses):
+    def unconditional(request):
+        assert "If-None-Match" not in request.headers
+        return aresponses.Response(
+            text='{"state": "NORMAL"}', content_type="application/json"
+        )
+
+    aresponses.add(response={"state": "NORMAL"})
+    aresponses.add(response=unconditional)
+    aresponses.add(response={"state": "ALERT"})
+
+    first = await api.request("GET", "spas/id1/status")
+    second = await api.request("GET", "spas/id1/status")
+    assert second == first
+    assert second is not first
+    assert api.stats.unchanged == 1
+    assert await api.request("GET", "spas/id1/status") == {"state": "ALERT"}
+
+
+async def test_response_cache_disabled(aresponses):
+    api = smarttub.SmartTub(session=object(), response_cache_size=0)
+    assert api.response_cache is None
+
+
+async def test_response_cache_size():
+    cache = smarttub.ResponseCache(maxsize=2)
+    for url in ("a", "b", "c"):
+        cache.put(url, smarttub.CachedResponse(None, None, url.encode()))
+    assert len(cache) == 2
+    assert cache.get("a") is None
+    assert cache.get("c").body == b"c"
+
+
+async def test_get_account_cached(api, aresponses):
+    aresponses.add(response={"id": "id1", "email": "email1"})
+    account = await api.get_account()
+    assert await api.get_account() is account
+    aresponses.assert_plan_strictly_followed()
+
+    aresponses.add(response={"id": "id1", "email": "email1"})
+    api.invalidate_cache("account")
+    assert await api.get_account() is not account
+    # spas are cached by the account, not here
+    with pytest.raises(ValueError):
+        api.invalidate_cache("spas")
+
+
+async def test_ttl_cache(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache = smarttub.TTLCache({"pumps": 60})
+    fetches = []
+
+    async def fetch():
+        fetches.append(now)
+        return len(fetches)
+
+    assert await cache.get("pumps", fetch) == 1
+    now += 59
+    assert await cache.get("pumps", fetch) == 1
+    now += 2
+    assert await cache.get("pumps", fetch) == 2
+    cache.invalidate()
+    assert await cache.get("pumps", fetch) == 3
+    assert await cache.get("lights", fetch) == 4
+    assert await cache.get("lights", fetch) == 5
+    with pytest.raises(ValueError):
+        cache.invalidate("account")
+
+
+async def test_coalesce_requests(api, aresponses):
+    async def handler(request):
+        await asyncio.sleep(0.01)
+        return aresponses.Response(
+            text='{"status": "OK"}', content_type="application/json"
+        )
+
+    aresponses.add(response=handler)
+    aresponses.add(response=handler)
+    responses = await asyncio.gather(
+        *[api.request("GET", "spas/id1/fullStatus") for _ in range(5)]
+    )
+    assert all(response == {"status": "OK"} for response in responses)
+    # each caller has its own copy
+    assert len({id(response) for response in responses}) == 5
+    assert api.stats.requests == 1
+    assert api.stats.coalesced == 4
+
+    # the next request, once the first has finished, isn't coalesced
+    await api.request("GET", "spas/id1/fullStatus")
+    assert api.stats.requests == 2
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_coalesce_requests_cancel(api, aresponses):
+    async def handler(request):
+        await asyncio.sleep(0.05)
+        return aresponses.Response(
+            text='{"status": "OK"}', content_type="application/json"
+        )
+
+    aresponses.add(response=handler)
+    first = asyncio.ensure_future(api.request("GET", "spas/id1/status"))
+    second = asyncio.ensure_future(api.request("GET", "spas/id1/status"))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert await second == {"status": "OK"}
+    assert api.stats.coalesced == 1
+
+
+def slow_handler(aresponses, delay):
+    async def handler(request):
+        await asyncio.sleep(delay)
+        return aresponses.Response(
+            text='{"status": "OK"}', content_type="application/json"
+        )
+
+    return handler
+
+
+async def test_coalesce_requests_deadlines(api, aresponses):
+    api.retry_policy = smarttub.RetryPolicy(max_attempts=1)
+    for _ in range(2):
+        aresponses.add(response=slow_handler(aresponses, 0.05))
+    # a request with a tight deadline can't be relied on by one without
+    leader = asyncio.ensure_future(
+        api.request("GET", "spas/id1/status", deadline=time.monotonic() + 0.01)
+    )
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(api.request("GET", "spas/id1/status"))
+    with pytest.raises(asyncio.TimeoutError):
+        await leader
+    assert await follower == {"status": "OK"}
+    assert api.stats.coalesced == 0
+
+    # but one with a later deadline than ours can
+    aresponses.add(response=slow_handler(aresponses, 0.01))
+    responses = await asyncio.gather(
+        api.request("GET", "spas/id1/status", deadline=time.monotonic() + 10),
+        api.request("GET", "spas/id1/status", deadline=time.monotonic() + 5),
+    )
+    assert responses == [{"status": "OK"}] * 2
+    assert api.stats.coalesced == 1
+
+
+async def test_coalesce_requests_leader_timeout(api, aresponses):
+    api.retry_policy = smarttub.RetryPolicy(max_attempts=1)
+    aresponses.add(response=slow_handler(aresponses, 0.5))
+    aresponses.add(response=slow_handler(aresponses, 0))
+    leader = asyncio.ensure_future(api.request("GET", "spas/id1/status", timeout=0.1))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(
+        api.request(
+            "GET", "spas/id1/status", timeout=0.1, deadline=time.monotonic() + 10
+        )
+    )
+    with pytest.raises(asyncio.TimeoutError):
+        await leader
+    # the request it joined timed out, but its own deadline hasn't passed
+    assert await follower == {"status": "OK"}
+    assert api.stats.coalesced == 1
+    assert api.stats.requests == 2
+
+
+async def test_coalesce_requests_disabled(api, aresponses):
+    api.coalesce_requests = False
+    for _ in range(2):
+        aresponses.add(response={"status": "OK"})
+    await asyncio.gather(*[api.request("GET", "spas/id1/status") for _ in range(2)])
+    assert api.stats.requests == 2
+    assert api.stats.coalesced == 0
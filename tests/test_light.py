@@ -30,7 +30,19 @@ async def test_light(mock_spa, lights):
     mock_spa.request.assert_called_with(
         "PATCH", f"lights/{purple.zone}", {"intensity": 50, "mode": "RED"}
     )
+    mock_spa.invalidate_cache.assert_called_with("lights")
     await purple.turn_off()
     mock_spa.request.assert_called_with(
         "PATCH", f"lights/{purple.zone}", {"intensity": 0, "mode": "OFF"}
     )
+
+
+async def test_light_deadline(mock_spa, lights):
+    await lights[0].turn_off(deadline=123.0)
+    mock_spa.request.assert_called_with(
+        "PATCH",
+        f"lights/{lights[0].zone}",
+        {"intensity": 0, "mode": "OFF"},
+        deadline=123.0,
+    )
+    assert mock_spa._wait_for_state_change.call_args.kwargs["deadline"] == 123.0
@@ -1,6 +1,6 @@
 import pytest
 
-from smarttub import SpaPump
+from smarttub import SpaPump, StateConfirmation
 
 pytestmark = pytest.mark.asyncio
 
@@ -34,3 +34,20 @@ async def test_pump(mock_spa, pumps):
     assert circ.type == SpaPump.PumpType.CIRCULATION
     await circ.toggle()
     mock_spa.request.assert_called_with("POST", f"pumps/{circ.id}/toggle")
+    mock_spa.invalidate_cache.assert_called_with("pumps")
+
+
+async def test_pump_deadline(mock_spa, pumps):
+    await pumps[0].toggle(deadline=123.0)
+    mock_spa.request.assert_called_with(
+        "POST", f"pumps/{pumps[0].id}/toggle", deadline=123.0
+    )
+    assert mock_spa._wait_for_state_change.call_args.kwargs["deadline"] == 123.0
+
+
+async def test_pump_toggle_no_wait(mock_spa, pumps):
+    confirmation = await pumps[0].toggle(wait=False)
+    assert isinstance(confirmation, StateConfirmation)
+    await confirmation
+    assert confirmation.done()
+    assert confirmation.status == StateConfirmation.Status.CONFIRMED
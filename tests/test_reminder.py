@@ -44,6 +44,7 @@ async def test_reminders(mock_spa, reminders):
     mock_spa.request.assert_called_with(
         "PATCH", "reminders/WATER", {"remainingDuration": 5}
     )
+    mock_spa.invalidate_cache.assert_called_with("reminders")
     mock_spa.reset_mock()
     await reminder.reset(365)
     mock_spa.request.assert_called_with(
@@ -1,7 +1,10 @@
+import asyncio
 import datetime
+import time
 from dateutil.tz import tzutc
-from unittest.mock import create_autospec
+from unittest.mock import ANY, create_autospec
 import copy
+import json
 
 import pytest
 
@@ -26,6 +29,23 @@ async def test_spa(spa):
     assert str(spa)
 
 
+async def test_refresh(mock_api, spa):
+    mock_api.request.return_value = {
+        "id": "id1",
+        "brand": "brand2",
+        "model": "model2",
+        "location": "backyard",
+    }
+    assert await spa.refresh() is spa
+    mock_api.request.assert_called_with("GET", "spas/id1")
+    assert spa.name == "brand2 model2"
+    assert spa.properties["location"] == "backyard"
+
+    # the response itself isn't modified through spa.properties
+    spa.properties["location"] = "garden"
+    assert mock_api.request.return_value["location"] == "backyard"
+
+
 async def test_get_status(mock_api, spa):
     mock_api.request.return_value = {
         "ambientTemperature": 65.6,
@@ -385,6 +405,133 @@ async def test_null_blowout(mock_api, spa):
     assert status.blowout_cycle is None
 
 
+async def test_lazy_state(mock_api, spa):
+    mock_api.request.return_value = canonical_full_status(heatMode="BOGUS")
+    status = await spa.get_status_full()
+    assert "water" not in vars(status)
+
+    water = status.water
+    assert water.temperature == 38.3
+    assert status.water is water
+    assert "water" in vars(status)
+    assert "locks" not in vars(status)
+
+    assert status.sensors == []
+    assert status.time == datetime.time(14, 45)
+    assert smarttub.SpaState(spa).set_temperature is None
+
+    # malformed fields only fail when they are accessed
+    with pytest.raises(KeyError):
+        status.heat_mode
+
+
+async def test_state_schema(mock_api, spa):
+    fields = smarttub.SpaState.fields()
+    assert fields["heat_mode"] == "heatMode"
+    assert fields["fields_last_updated"] == "fieldsLastUpdated"
+    assert "pumps" not in fields
+
+    full_fields = smarttub.SpaStateFull.fields()
+    assert full_fields["pumps"] == "pumps"
+    assert full_fields["heat_mode"] == "heatMode"
+    assert dict(smarttub.SpaWaterState.fields()) == {
+        "temperature": "temperature",
+        "temperature_last_updated": "temperatureLastUpdated",
+    }
+
+    mock_api.request.return_value = canonical_status()
+    status = await spa.get_status()
+    # fields are parsed through the schema, not looked up on the class
+    assert not hasattr(smarttub.SpaState, "heat_mode")
+    assert "heat_mode" not in vars(status)
+    assert status.heat_mode == smarttub.Spa.HeatMode.AUTO
+    assert vars(status)["heat_mode"] is status.heat_mode
+    with pytest.raises(AttributeError):
+        status.no_such_field
+
+    state = status.to_dict()
+    assert set(state) == set(fields)
+    assert state["heat_mode"] == "AUTO"
+    assert state["water"]["temperature"] == 38.3
+    assert state["primary_filtration"]["start_hour"] == 2
+    assert state["primary_filtration"]["mode"] == "NORMAL"
+    assert state["locks"]["spa"] == {"kind": "spa", "state": "UNLOCKED"}
+    assert state["last_updated"] == status.last_updated.isoformat()
+    assert json.loads(json.dumps(state)) == state
+
+    mock_api.request.return_value = canonical_full_status()
+    state = (await spa.get_status_full()).to_dict()
+    assert state["pumps"][0] == {
+        "id": "P1",
+        "speed": "ONE_SPEED",
+        "state": "OFF",
+        "type": "JET",
+    }
+    assert state["lights"][0]["mode"] == "OFF"
+    json.dumps(state)
+
+
+async def test_compact_models(mock_api, spa):
+    mock_api.request.return_value = canonical_full_status()
+    status = await spa.get_status_full()
+    error = smarttub.SpaError(
+        spa,
+        code=11,
+        title="Flow Switch Stuck Open",
+        description=None,
+        createdAt="2019-12-11T18:51:10.123Z",
+        updatedAt="2020-07-14T19:00:50.705Z",
+        active=True,
+        errorType="TUB_ERROR",
+    )
+    for obj in [status.pumps[0], status.lights[0], status.locks["spa"], error]:
+        assert not hasattr(obj, "__dict__")
+    assert status.pumps[0].properties["id"] == "P1"
+
+    mock_api.keep_raw_properties = False
+    status = await spa.get_status_full()
+    assert status.pumps[0].properties is None
+    assert status.lights[0].properties is None
+    assert status.lights[0].zone == 1
+
+
+async def test_parse_timestamp():
+    parse = smarttub.api._parse_timestamp
+    assert parse("2021-02-21T21:32:36.215Z") == datetime.datetime(
+        2021, 2, 21, 21, 32, 36, 215000, tzinfo=tzutc()
+    )
+    assert parse("2025-02-17T19:19:38.879670Z") == datetime.datetime(
+        2025, 2, 17, 19, 19, 38, 879670, tzinfo=tzutc()
+    )
+    assert parse("2021-02-21") == datetime.datetime(2021, 2, 21)
+    # not supported by datetime.fromisoformat
+    assert parse("2021-02") == datetime.datetime(2021, 2, 1)
+    assert parse("2021-02-21T24:00:00Z") == datetime.datetime(
+        2021, 2, 22, tzinfo=tzutc()
+    )
+
+
+async def test_state_timestamps_shared(mock_account):
+    # timestamps are shared by all spas on the same SmartTub instance
+    api = smarttub.SmartTub(session=object())
+    spas = [
+        smarttub.Spa(api, mock_account, id=spa_id, brand="brand1", model="model1")
+        for spa_id in ["id1", "id2"]
+    ]
+    status = canonical_full_status(
+        fieldsLastUpdated={"heatMode": "2020-07-09T19:40:01.883Z", "uv": None}
+    )
+    first, second = [smarttub.SpaStateFull(spa, status) for spa in spas]
+    assert first.fields_last_updated["heatMode"] is (
+        second.fields_last_updated["heatMode"]
+    )
+    assert first.fields_last_updated["uv"] is None
+    assert first.last_updated is second.last_updated
+    assert first.water.temperature_last_updated is (
+        second.water.temperature_last_updated
+    )
+
+
 async def test_get_pumps(mock_api, spa):
     mock_api.request.return_value = {
         "pumps": [
@@ -402,6 +549,45 @@ async def test_get_pumps(mock_api, spa):
     assert pump.id == "pid1"
 
 
+async def test_get_status_full_missing_pumps(mock_api, spa):
+    full_status = canonical_full_status()
+    del full_status["pumps"]
+    mock_api.request.return_value = full_status
+    with pytest.raises(KeyError):
+        await spa.get_status_full()
+
+
+async def test_get_pumps_fresh_state(mock_api, spa):
+    mock_api.request.side_effect = [
+        {"pumps": [{"id": "pid1", "speed": "speed1", "state": state, "type": "JET"}]}
+        for state in ("OFF", "HIGH")
+    ]
+    assert (await spa.get_pumps())[0].state == smarttub.SpaPump.PumpState.OFF
+    # pumps aren't cached by default, since their state changes
+    assert (await spa.get_pumps())[0].state == smarttub.SpaPump.PumpState.HIGH
+
+
+async def test_get_pumps_cached(mock_api, spa):
+    mock_api.request.return_value = {
+        "pumps": [{"id": "pid1", "speed": "speed1", "state": "OFF", "type": "JET"}]
+    }
+    spa._cache.ttl = {"pumps": 60}
+    pumps = await spa.get_pumps()
+    assert await spa.get_pumps() == pumps
+    assert mock_api.request.call_count == 1
+
+    spa.invalidate_cache("pumps")
+    assert await spa.get_pumps() != pumps
+    assert mock_api.request.call_count == 2
+    with pytest.raises(ValueError):
+        spa.invalidate_cache("spas")
+
+    spa._cache.ttl = {"pumps": 0}
+    await spa.get_pumps()
+    await spa.get_pumps()
+    assert mock_api.request.call_count == 4
+
+
 async def test_get_lights(mock_api, spa):
     mock_api.request.return_value = {
         "lights": [
@@ -625,7 +811,7 @@ async def test_set_heat_mode(mock_api, spa):
     setup_state_change_mock(mock_api, patch_args, {"heatMode": "AUTO"})
     await spa.set_heat_mode(smarttub.Spa.HeatMode.AUTO)
     mock_api.request.assert_any_call(*patch_args)
-    mock_api.request.assert_any_call("GET", f"spas/{spa.id}/status", None)
+    mock_api.request.assert_any_call("GET", f"spas/{spa.id}/status", None, deadline=ANY)
 
 
 async def test_set_temperature(mock_api, spa):
@@ -633,7 +819,334 @@ async def test_set_temperature(mock_api, spa):
     setup_state_change_mock(mock_api, patch_args, {"setTemperature": 38.3})
     await spa.set_temperature(38.3)
     mock_api.request.assert_any_call(*patch_args)
-    mock_api.request.assert_any_call("GET", f"spas/{spa.id}/status", None)
+    mock_api.request.assert_any_call("GET", f"spas/{spa.id}/status", None, deadline=ANY)
+
+
+async def test_set_temperature_deadline(mock_api, spa):
+    deadline = time.monotonic() + 30
+    patch_args = ("PATCH", f"spas/{spa.id}/config", {"setTemperature": 38.3})
+    setup_state_change_mock(mock_api, patch_args, {"setTemperature": 38.3})
+    await spa.set_temperature(38.3, deadline=deadline)
+    mock_api.request.assert_any_call(*patch_args, deadline=deadline)
+    status_call = mock_api.request.call_args_list[-1]
+    assert status_call.args == ("GET", f"spas/{spa.id}/status", None)
+    assert status_call.kwargs["deadline"] <= deadline
+
+
+async def test_wait_for_state_change_poll_deadline(mock_api, spa):
+    deadlines = []
+
+    async def request(method, path, body=None, deadline=None):
+        deadlines.append(deadline)
+        return canonical_full_status(state="STARTING")
+
+    mock_api.request.side_effect = request
+    poll = smarttub.PollStrategy(initial_delay=0.001, max_delay=0.001, timeout=0.05)
+    with pytest.raises(smarttub.StateChangeTimeout):
+        await spa._wait_for_state_change(
+            lambda state: state.state == "NORMAL", poll=poll
+        )
+    # each poll is bounded by the check's timeout, not just the request timeout
+    end = time.monotonic()
+    assert deadlines
+    assert all(d is not None and d <= end for d in deadlines)
+
+
+async def test_set_temperature_no_wait(mock_api, spa):
+    patch_args = ("PATCH", f"spas/{spa.id}/config", {"setTemperature": 38.3})
+    setup_state_change_mock(mock_api, patch_args, {"setTemperature": 38.3})
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    confirmation = await spa.set_temperature(38.3, poll=poll, wait=False)
+    mock_api.request.assert_called_once_with(*patch_args)
+    assert confirmation.status == smarttub.StateConfirmation.Status.PENDING
+    assert str(confirmation)
+
+    state = await confirmation
+    assert state.set_temperature == 38.3
+    assert confirmation.result() is state
+    assert confirmation.status == smarttub.StateConfirmation.Status.CONFIRMED
+
+
+async def test_set_heat_mode_no_wait_timeout(mock_api, spa):
+    patch_args = ("PATCH", f"spas/{spa.id}/config", {"heatMode": "AUTO"})
+    setup_state_change_mock(mock_api, patch_args, {"heatMode": "ECONOMY"})
+    poll = smarttub.PollStrategy(initial_delay=0.001, timeout=0.01)
+    confirmations = [
+        await spa.set_heat_mode(smarttub.Spa.HeatMode.AUTO, poll=poll, wait=False)
+        for _ in range(2)
+    ]
+    results = await asyncio.gather(*confirmations, return_exceptions=True)
+    assert all(isinstance(r, smarttub.StateChangeTimeout) for r in results)
+    assert all(
+        c.status == smarttub.StateConfirmation.Status.TIMED_OUT for c in confirmations
+    )
+
+
+async def test_wait_for_state_change_deadline(mock_api, spa):
+    mock_api.request.side_effect = asyncio.TimeoutError
+    with pytest.raises(RuntimeError):
+        await spa._wait_for_state_change(
+            lambda state: True, deadline=time.monotonic() + 1
+        )
+
+
+async def test_wait_for_state_change_timeout(mock_api, spa):
+    mock_api.request.return_value = canonical_full_status()
+    with pytest.raises(RuntimeError):
+        await spa._wait_for_state_change(
+            lambda state: False,
+            get_status_method=spa.get_status_full,
+            deadline=time.monotonic(),
+        )
+
+
+async def test_wait_for_state_change_polls_once(mock_api, spa):
+    mock_api.request.side_effect = [
+        canonical_full_status(state="STARTING"),
+        canonical_full_status(state="NORMAL"),
+    ]
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    state = await spa._wait_for_state_change(
+        lambda state: state.state == "NORMAL",
+        get_status_method=spa.get_status_full,
+        poll=poll,
+    )
+    assert state.state == "NORMAL"
+    assert [call.args[1] for call in mock_api.request.call_args_list] == [
+        f"spas/{spa.id}/fullStatus",
+        f"spas/{spa.id}/fullStatus",
+    ]
+
+
+async def test_state_changes_share_polls(mock_api, spa):
+    states = iter(["STARTING", "NORMAL"])
+    mock_api.request.side_effect = lambda *args, **kwargs: canonical_full_status(
+        state=next(states)
+    )
+    poll = smarttub.PollStrategy(initial_delay=0.001, max_delay=0.001)
+
+    def check(expected, full):
+        return spa._wait_for_state_change(
+            lambda state: state.state == expected,
+            get_status_method=spa.get_status_full if full else None,
+            poll=poll,
+        )
+
+    results = await asyncio.gather(
+        check("STARTING", True), check("NORMAL", True), check("NORMAL", False)
+    )
+    assert [state.state for state in results] == ["STARTING", "NORMAL", "NORMAL"]
+    # all three waits were served by the same two fullStatus requests
+    assert [call.args[1] for call in mock_api.request.call_args_list] == [
+        f"spas/{spa.id}/fullStatus",
+        f"spas/{spa.id}/fullStatus",
+    ]
+    assert results[1] is results[2]
+    assert spa._confirmer.pending == 0
+
+
+async def test_state_change_error_shared(mock_api, spa):
+    mock_api.request.side_effect = smarttub.APIError("unavailable")
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    results = await asyncio.gather(
+        *[spa._wait_for_state_change(lambda state: True, poll=poll) for _ in range(3)],
+        return_exceptions=True,
+    )
+    assert all(isinstance(r, smarttub.APIError) for r in results)
+    assert mock_api.request.call_count == 1
+
+
+async def test_apply(mock_api, spa):
+    current = canonical_full_status(heatMode="AUTO", setTemperature=38.3)
+    writes = []
+
+    async def request(method, path, body=None, **kwargs):
+        if method == "GET":
+            return copy.deepcopy(current)
+        writes.append((method, path, body))
+        if path == f"spas/{spa.id}/pumps/P1/toggle":
+            current["pumps"][0]["state"] = "HIGH"
+        elif path == f"spas/{spa.id}/lights/1":
+            current["lights"][0].update(mode=body["mode"], intensity=body["intensity"])
+
+    mock_api.request.side_effect = request
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    changes = await spa.apply(
+        smarttub.DesiredState(
+            set_temperature=38.3,
+            heat_mode=smarttub.Spa.HeatMode.AUTO,
+            pumps={"P1": True, "CP": False},
+            lights={1: (smarttub.SpaLight.LightMode.RED, 100)},
+        ),
+        poll=poll,
+    )
+
+    # only the pump and light differed from the desired state
+    assert sorted(writes) == [
+        ("PATCH", f"spas/{spa.id}/lights/1", {"intensity": 100, "mode": "RED"}),
+        ("POST", f"spas/{spa.id}/pumps/P1/toggle", None),
+    ]
+    assert sorted(type(target).__name__ for target in changes) == [
+        "SpaLight",
+        "SpaPump",
+    ]
+    assert all(
+        confirmation.status == smarttub.StateConfirmation.Status.CONFIRMED
+        for confirmation in changes.values()
+    )
+
+
+async def test_apply_settings(mock_api, spa):
+    current = canonical_full_status(
+        heatMode="AUTO", setTemperature=38.3, displayTemperatureFormat="FAHRENHEIT"
+    )
+    writes = []
+
+    async def request(method, path, body=None, **kwargs):
+        if method == "GET":
+            return copy.deepcopy(current)
+        writes.append((method, path, body))
+        if "setTemperature" in body:
+            current["setTemperature"] = body["setTemperature"]
+        if "heatMode" in body:
+            current["heatMode"] = body["heatMode"]
+        if "displayTemperatureFormat" in body:
+            current["displayTemperatureFormat"] = body["displayTemperatureFormat"]
+
+    mock_api.request.side_effect = request
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    changes = await spa.apply(
+        smarttub.DesiredState(
+            set_temperature=37.04,
+            heat_mode=smarttub.Spa.HeatMode.ECONOMY,
+            temperature_format=smarttub.Spa.TemperatureFormat.CELSIUS,
+        ),
+        poll=poll,
+    )
+
+    assert sorted(writes, key=str) == [
+        ("PATCH", f"spas/{spa.id}/config", {"heatMode": "ECONOMY"}),
+        ("PATCH", f"spas/{spa.id}/config", {"setTemperature": 37.0}),
+        ("POST", f"spas/{spa.id}/config", {"displayTemperatureFormat": "CELSIUS"}),
+    ]
+    assert set(changes) == {"set_temperature", "heat_mode", "temperature_format"}
+    assert all(
+        confirmation.status == smarttub.StateConfirmation.Status.CONFIRMED
+        for confirmation in changes.values()
+    )
+
+
+async def test_apply_missing(mock_api, spa):
+    mock_api.request.return_value = canonical_full_status()
+    red = (smarttub.SpaLight.LightMode.RED, 100)
+    with pytest.raises(ValueError):
+        await spa.apply(smarttub.DesiredState(pumps={"P2": True}))
+    with pytest.raises(ValueError):
+        await spa.apply(smarttub.DesiredState(lights={2: red}))
+    desired = smarttub.DesiredState(pumps={"P2": True}, lights={2: red})
+    assert await spa.apply(desired, ignore_missing=True) == {}
+    # nothing was written
+    assert {call.args[0] for call in mock_api.request.call_args_list} == {"GET"}
+
+
+async def test_apply_all_lights(mock_api, spa):
+    current = canonical_full_status()
+    current["lights"].append(
+        {
+            "zone": 3,
+            "color": {"red": 0, "green": 0, "blue": 0, "white": 0},
+            "intensity": 50,
+            "mode": "PURPLE",
+        }
+    )
+    writes = []
+
+    async def request(method, path, body=None, **kwargs):
+        if method == "GET":
+            return copy.deepcopy(current)
+        writes.append((method, path, body))
+        zone = int(path.rsplit("/", 1)[1])
+        for light in current["lights"]:
+            if light["zone"] == zone:
+                light.update(mode=body["mode"], intensity=body["intensity"])
+
+    mock_api.request.side_effect = request
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    changes = await spa.apply(
+        smarttub.DesiredState(
+            all_lights=(smarttub.SpaLight.LightMode.RED, 100),
+            lights={3: (smarttub.SpaLight.LightMode.OFF, 0)},
+        ),
+        poll=poll,
+    )
+    # every light the spa has, with zone 3 overridden
+    assert sorted(writes) == [
+        ("PATCH", f"spas/{spa.id}/lights/1", {"intensity": 100, "mode": "RED"}),
+        ("PATCH", f"spas/{spa.id}/lights/3", {"intensity": 0, "mode": "OFF"}),
+    ]
+    assert sorted(light.zone for light in changes) == [1, 3]
+
+
+async def test_apply_partial_failure(mock_api, spa):
+    current = canonical_full_status()
+    writes = []
+
+    async def request(method, path, body=None, **kwargs):
+        if method == "GET":
+            return copy.deepcopy(current)
+        if path == f"spas/{spa.id}/pumps/P1/toggle":
+            raise smarttub.APIError("unavailable")
+        writes.append((method, path, body))
+        current["lights"][0].update(mode=body["mode"], intensity=body["intensity"])
+
+    mock_api.request.side_effect = request
+    poll = smarttub.PollStrategy(initial_delay=0.001)
+    with pytest.raises(smarttub.ApplyFailed) as exc_info:
+        await spa.apply(
+            smarttub.DesiredState(
+                pumps={"P1": True}, lights={1: (smarttub.SpaLight.LightMode.RED, 100)}
+            ),
+            poll=poll,
+        )
+    error = exc_info.value
+    assert isinstance(error.__cause__, smarttub.APIError)
+    # the light was still changed, and confirmed
+    assert writes == [
+        ("PATCH", f"spas/{spa.id}/lights/1", {"intensity": 100, "mode": "RED"})
+    ]
+    statuses = {
+        type(target).__name__: confirmation.status
+        for target, confirmation in error.confirmations.items()
+    }
+    assert statuses == {
+        "SpaPump": smarttub.StateConfirmation.Status.FAILED,
+        "SpaLight": smarttub.StateConfirmation.Status.CONFIRMED,
+    }
+
+    # without waiting, the failure is reported as soon as the writes are sent
+    current["lights"][0].update(mode="OFF", intensity=0)
+    with pytest.raises(smarttub.ApplyFailed) as exc_info:
+        await spa.apply(
+            smarttub.DesiredState(
+                pumps={"P1": True}, lights={1: (smarttub.SpaLight.LightMode.RED, 100)}
+            ),
+            poll=poll,
+            wait=False,
+        )
+    statuses = [c.status for c in exc_info.value.confirmations.values()]
+    assert smarttub.StateConfirmation.Status.FAILED in statuses
+    await asyncio.gather(*exc_info.value.confirmations.values(), return_exceptions=True)
+
+
+async def test_poll_strategy():
+    poll = smarttub.PollStrategy(initial_delay=0.25, backoff=2, max_delay=2)
+    assert [poll.delay(attempt) for attempt in range(1, 6)] == [
+        0.25,
+        0.5,
+        1,
+        2,
+        2,
+    ]
 
 
 async def test_toggle_clearray(mock_api, spa):
@@ -652,7 +1165,7 @@ async def test_set_temperature_format(mock_api, spa):
     )
     await spa.set_temperature_format(smarttub.Spa.TemperatureFormat.FAHRENHEIT)
     mock_api.request.assert_any_call(*patch_args)
-    mock_api.request.assert_any_call("GET", f"spas/{spa.id}/status", None)
+    mock_api.request.assert_any_call("GET", f"spas/{spa.id}/status", None, deadline=ANY)
 
 
 async def test_set_date_time(mock_api, spa):